@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    batch_infer.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+cohort-scale batch inference with the exported generators (python main.py --phase export).
+patients (A list -> generatorX2Y, B list -> generatorY2X) are processed by --workers processes,
+each with its own loaded generators and --threads intra-op threads. finished patients are recorded in a
+state file (one json line per patient), a rerun skips them.
+    python batch_infer.py --model_dir <export_dir>/<taskID> --data_path <dcm dir> --A_list A_list.txt
+                          --B_list B_list.txt --output_dir <save dir> --workers 8 --threads 4 --output dicom
+    multiple hosts : --num_shards <# of hosts> --shard_index <host no> (each host its own state file)
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from pydicom.uid import generate_uid
+import inout_util as ut
+
+# state of a worker process : loaded generators, data loader of the patient file lists
+_worker = {}
+
+
+def init_worker(model_dir, threads, data_path, extension, manifest):
+    # thread budget of this process, before tensorflow creates its thread pools
+    import tensorflow as tf
+    if threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    _worker['model_dir'] = model_dir
+    _worker['models'] = {}
+    _worker['loader'] = ut.DCMDataLoader(data_path, extension=extension, manifest=manifest)
+
+
+def get_model(direction, batch_size):
+    import infer
+    if direction not in _worker['models']:
+        _worker['models'][direction] = infer.GeneratorInference(
+            os.path.join(_worker['model_dir'], infer.GENERATOR_NAMES[direction]), batch_size=batch_size)
+    return _worker['models'][direction]
+
+
+def denoise_patient(patent_no, domain, output_dir, output, batch_size):
+    """
+    one patient series in a worker process, domain A : generatorX2Y, B : generatorY2X
+    output volume : Gen_from_<patent_no>_<domain>.npy (+ json), dicom : <patent_no>_<domain>/<source file name>
+    returns the state record
+    """
+    t = time.time()
+    model = get_model('X2Y' if domain == 'A' else 'Y2X', batch_size)
+    files = _worker['loader'].get_files(patent_no)
+    if not files:
+        raise ValueError('no slices : {}'.format(patent_no))
+
+    if output == 'dicom':
+        series_dir = os.path.join(output_dir, '{}_{}'.format(patent_no, domain))
+        if not os.path.exists(series_dir):
+            os.makedirs(series_dir)
+        series_uid = generate_uid()
+        for path, img in model.run_files(files):
+            ut.write_dicom_slice(path, os.path.join(series_dir, os.path.basename(path)), img, model.image_min,
+                                 model.image_max, series_uid, 'Gen_from_{}_{}'.format(patent_no, domain))
+        output_path = series_dir
+    else:
+        writer = ut.VolumeWriter(output_dir, [patent_no], [files], domain, model.image_min, model.image_max)
+        writer.start()
+        for _, img in model.run_files(files):
+            writer.put(img[np.newaxis])
+        writer.close()
+        output_path = writer.volume_path(patent_no)
+
+    return {'patent_no': patent_no, 'domain': domain, 'slices': len(files), 'seconds': time.time() - t,
+            'worker': os.getpid(), 'output': output_path}
+
+
+def load_state(state_path):
+    done = set()
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    done.add((record['patent_no'], record['domain']))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description='batch inference of patient lists with the exported generators')
+    parser.add_argument('--model_dir', dest='model_dir', required=True,
+                        help='<export_dir>/<taskID> with the exported generatorX2Y / generatorY2X')
+    parser.add_argument('--data_path', dest='data_path', required=True, help='dicom file directory')
+    parser.add_argument('--extension', dest='extension', default='dcm', help='file extension')
+    parser.add_argument('--manifest', dest='manifest', default=None, help='patient manifest json (slice order)')
+    parser.add_argument('--A_list', dest='patient_no_A', type=ut.ParseList, default=[],
+                        help='patients denoised with generatorX2Y, comma separated or .txt list')
+    parser.add_argument('--B_list', dest='patient_no_B', type=ut.ParseList, default=[],
+                        help='patients denoised with generatorY2X, comma separated or .txt list')
+    parser.add_argument('--output_dir', dest='output_dir', required=True, help='output save dir')
+    parser.add_argument('--output', dest='output', default='volume', choices=['volume', 'dicom'],
+                        help='volume : one .npy volume (+ json) per patient, dicom : source headers, new series uid')
+    parser.add_argument('--workers', dest='workers', type=int, default=max(os.cpu_count() // 4, 1),
+                        help='# of worker processes')
+    parser.add_argument('--threads', dest='threads', type=int, default=0,
+                        help='intra-op threads per worker (0 : cpu count / workers)')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=8,
+                        help='# of slices per generator call (folded export only, else 1)')
+    parser.add_argument('--state_file', dest='state_file', default=None,
+                        help='finished patients (json lines), default : <output_dir>/batch_infer_state.jsonl')
+    parser.add_argument('--num_shards', dest='num_shards', type=int, default=1, help='# of hosts')
+    parser.add_argument('--shard_index', dest='shard_index', type=int, default=0, help='patients of this host')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    state_path = args.state_file or os.path.join(args.output_dir, 'batch_infer_state.jsonl')
+    threads = args.threads if args.threads > 0 else max(os.cpu_count() // args.workers, 1)
+
+    tasks = [(p, 'A') for p in args.patient_no_A if p] + [(p, 'B') for p in args.patient_no_B if p]
+    tasks = tasks[args.shard_index::args.num_shards]
+    done = load_state(state_path)
+    todo = [task for task in tasks if task not in done]
+    print('patients : {}, done : {}, todo : {}, workers : {} x {} threads'.format(
+        len(tasks), len(tasks) - len(todo), len(todo), args.workers, threads))
+    if not todo:
+        return
+
+    # spawned workers : each process loads its own tensorflow runtime and generators
+    # patients are handed out one at a time, so the workers stay busy whatever the series lengths
+    t = time.time()
+    slices, failed = 0, []
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,
+                             initargs=(args.model_dir, threads, args.data_path, args.extension,
+                                       args.manifest)) as pool, open(state_path, 'a') as state:
+        futures = {pool.submit(denoise_patient, patent_no, domain, args.output_dir, args.output,
+                               args.batch_size): (patent_no, domain) for patent_no, domain in todo}
+        for future in as_completed(futures):
+            patent_no, domain = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                # same keys as the state records, a rerun retries exactly these (patient, domain) jobs
+                failed.append({'patent_no': patent_no, 'domain': domain, 'error': str(e)})
+                print('[!] {} ({}) failed : {}'.format(patent_no, domain, e))
+                continue
+            state.write(json.dumps(record) + '\n')
+            state.flush()
+            slices += record['slices']
+            print('{} ({}) : {} slices, {:.1f}s'.format(patent_no, domain, record['slices'], record['seconds']))
+
+    elapsed = time.time() - t
+    report = {'patients': len(todo) - len(failed), 'failed': failed, 'slices': slices, 'seconds': elapsed,
+              'slices_per_sec': slices / elapsed, 'workers': args.workers, 'threads': threads}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
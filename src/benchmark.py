@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    benchmark.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+throughput benchmarks on synthetic data, runs on a CPU-only machine.
+    python benchmark.py train_step --patch_size 56 --batch_size 10 --ngf 32 --steps 20
+    python benchmark.py scaling --replicas 1,2,4 --patch_size 56 --batch_size 10 --steps 20
+    python benchmark.py memory --patch_sizes 56,128,256 --batch_sizes 4,10 --steps 5
+    python benchmark.py precision --precisions float32,mixed_bfloat16,mixed_float16 --patch_size 56 --batch_size 10
+    python benchmark.py foreground --data_path <dcm dir> --train_A L067 --train_B L067_B50 --test_A L096
+                                   --test_B L096_B50 --min_tissue_fraction 0.5 --train_steps 200
+    python benchmark.py suite --size 512 --slices 16 --patch_sizes 56,128 --batch_sizes 4,10 --ngfs 32,128
+                              --output bench_<commit>.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage
+import tensorflow as tf
+from cycle_identity_model import cycle_identity
+import inout_util as ut
+import train_util as tu
+
+
+# model / train arguments of main.py used by cycle_identity
+def model_args(**kwargs):
+    args = argparse.Namespace(taskID='benchmark', checkpoint_dir=tempfile.mkdtemp(), phase='train',
+                              patch_size=56, whole_size=512, img_channel=1, img_vmax=3072, img_vmin=-1024,
+                              batch_size=10, lr=0.0002, beta1=0.5, beta2=0.999, L1_lambda=10.0, L1_gamma=5.0,
+                              ngf=128, nglf=15, ndf=64, jit=False, summary_stats=False,
+                              distribute='none', cpu_replicas=0,
+                              recompute=False, precision='float32', keep_checkpoints=1, keep_best=1, async_checkpoint=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def sync(model):
+    # wait for the pending step : read back one generator variable
+    return float(tf.reduce_sum(model.generator_G.trainable_variables[0]))
+
+
+def benchmark_train_step(args, steps=20, warmup=3):
+    """seconds per train_step on random patches (warmup steps include tracing / XLA compilation)"""
+    model = cycle_identity(args, load_data=False)
+    train_step = model.build_train_step(args, model.g_optim, model.d_optim)
+
+    # one random global batch, repeated and split over the replicas
+    shape = [args.batch_size, args.patch_size, args.patch_size, args.img_channel]
+    patches = tf.data.Dataset.from_tensor_slices((tf.random.uniform(shape), tf.random.uniform(shape)))
+    patches = iter(model.strategy.experimental_distribute_dataset(patches.batch(args.batch_size).repeat()))
+
+    for _ in range(warmup):
+        train_step(*next(patches))
+    sync(model)
+
+    t = time.time()
+    for _ in range(steps):
+        train_step(*next(patches))
+    sync(model)
+    return (time.time() - t) / steps
+
+
+def run_train_step(opt):
+    result = {}
+    for jit in (False, True):
+        args = model_args(patch_size=opt.patch_size, batch_size=opt.batch_size,
+                          ngf=opt.ngf, nglf=opt.nglf, ndf=opt.ndf, jit=jit)
+        result['jit' if jit else 'default'] = benchmark_train_step(args, opt.steps, opt.warmup)
+    result['speedup'] = result['default'] / result['jit']
+    return result
+
+
+def run_replica_step(opt):
+    """train step of --cpu_replicas replicas (MirroredStrategy), batch_size per replica"""
+    replicas = max(opt.cpu_replicas, 1)
+    args = model_args(patch_size=opt.patch_size, batch_size=opt.batch_size * replicas,
+                      ngf=opt.ngf, nglf=opt.nglf, ndf=opt.ndf, distribute='mirrored', cpu_replicas=replicas)
+    sec = benchmark_train_step(args, opt.steps, opt.warmup)
+    return {'replicas': replicas, 'sec_per_step': sec, 'samples_per_sec': args.batch_size / sec}
+
+
+def run_scaling(opt):
+    """
+    run_replica_step for each replica count in a new process (logical devices are fixed at tensorflow start).
+    the cpu threads are shared by the replicas, so the speedup is bounded by the number of cores
+    """
+    result = []
+    for replicas in [int(r) for r in opt.replicas.split(',')]:
+        cmd = [sys.executable, os.path.abspath(__file__), 'replica_step', '--cpu_replicas', str(replicas),
+               '--patch_size', str(opt.patch_size), '--batch_size', str(opt.batch_size), '--ngf', str(opt.ngf),
+               '--nglf', str(opt.nglf), '--ndf', str(opt.ndf), '--steps', str(opt.steps),
+               '--warmup', str(opt.warmup)]
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        result.append(json.loads(output[output.rindex('{'):]))  # last line : result json
+    for r in result:
+        r['speedup'] = r['samples_per_sec'] / result[0]['samples_per_sec']
+    return result
+
+
+# peak resident memory of this process (MB)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_memory_step(opt):
+    """train step time and peak memory of one (patch_size, batch_size, recompute) setting"""
+    args = model_args(patch_size=opt.patch_size, batch_size=opt.batch_size, ngf=opt.ngf, nglf=opt.nglf,
+                      ndf=opt.ndf, recompute=opt.recompute)
+    base_rss = peak_rss()
+    sec = benchmark_train_step(args, opt.steps, opt.warmup)
+    return {'patch_size': args.patch_size, 'batch_size': args.batch_size, 'recompute': args.recompute,
+            'sec_per_step': sec, 'base_rss_mb': base_rss, 'peak_rss_mb': peak_rss()}
+
+
+def run_memory(opt):
+    """
+    peak memory vs step time with and without --recompute, one new process per setting (peak rss only grows).
+    peak_rss_mb - base_rss_mb : memory of the models, optimizer states and step activations
+    """
+    result = []
+    for patch_size in [int(p) for p in opt.patch_sizes.split(',')]:
+        for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+            for recompute in (False, True):
+                cmd = [sys.executable, os.path.abspath(__file__), 'memory_step', '--recompute', str(recompute),
+                       '--patch_size', str(patch_size), '--batch_size', str(batch_size), '--ngf', str(opt.ngf),
+                       '--nglf', str(opt.nglf), '--ndf', str(opt.ndf), '--steps', str(opt.steps),
+                       '--warmup', str(opt.warmup)]
+                output = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+                result.append(json.loads(output[output.rindex('{'):]))  # last line : result json
+    return result
+
+
+def run_precision_step(opt):
+    """
+    one --precision setting : train step time / peak memory, and the generator output (saved to opt.output)
+    on a fixed input before and after the timed steps, from the same seeded initial weights and patches
+    """
+    tf.keras.utils.set_random_seed(0)
+    args = model_args(patch_size=opt.patch_size, batch_size=opt.batch_size, ngf=opt.ngf, nglf=opt.nglf,
+                      ndf=opt.ndf, precision=opt.precision)
+    model = cycle_identity(args, load_data=False)
+    train_step = model.build_train_step(args, model.g_optim, model.d_optim)
+    rng = np.random.RandomState(0)
+    shape = [args.batch_size, args.patch_size, args.patch_size, args.img_channel]
+    patch_X, patch_Y = rng.uniform(size=shape).astype(np.float32), rng.uniform(size=shape).astype(np.float32)
+    sample = rng.uniform(size=[1, opt.size, opt.size, args.img_channel]).astype(np.float32)
+
+    outputs = {'init': model.generator_G(sample, training=False).numpy()}
+    base_rss = peak_rss()
+    for _ in range(opt.warmup):
+        train_step(patch_X, patch_Y)
+    sync(model)
+    t = time.time()
+    for _ in range(opt.steps):
+        train_step(patch_X, patch_Y)
+    sync(model)
+    sec = (time.time() - t) / opt.steps
+    outputs['trained'] = model.generator_G(sample, training=False).numpy()
+    np.savez(opt.output, **outputs)
+    return {'precision': opt.precision, 'sec_per_step': sec, 'samples_per_sec': args.batch_size / sec,
+            'base_rss_mb': base_rss, 'peak_rss_mb': peak_rss()}
+
+
+def run_precision(opt):
+    """
+    float32 vs mixed precision policies, one new process per policy (global policy, peak rss).
+    parity : PSNR of the generator output against the float32 output (same scale as the training summary),
+             init : same weights, trained : after warmup + steps train steps on the same patches
+    """
+    work_dir = tempfile.mkdtemp()
+    result = []
+    for precision in opt.precisions.split(','):
+        output_path = os.path.join(work_dir, precision + '.npz')
+        cmd = [sys.executable, os.path.abspath(__file__), 'precision_step', '--precision', precision,
+               '--patch_size', str(opt.patch_size), '--batch_size', str(opt.batch_size), '--ngf', str(opt.ngf),
+               '--nglf', str(opt.nglf), '--ndf', str(opt.ndf), '--steps', str(opt.steps),
+               '--warmup', str(opt.warmup), '--size', str(opt.size), '--output', output_path]
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        r = json.loads(output[output.rindex('{'):])  # last line : result json
+        r['outputs'] = dict(np.load(output_path))
+        result.append(r)
+    reference = result[0]
+    for r in result:
+        r['speedup'] = r['samples_per_sec'] / reference['samples_per_sec']
+        for key in ('init', 'trained'):
+            r['psnr_vs_' + reference['precision'] + '_' + key] = float(
+                ut.tf_psnr(reference['outputs'][key], r['outputs'][key], 2))
+    for r in result:
+        del r['outputs']
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def train_curve(opt, loader, eval_subset):
+    """PSNR of the eval subset every opt.eval_every steps, same initial weights and seed for every sampling mode"""
+    tf.random.set_seed(0)
+    args = model_args(patch_size=opt.patch_size, batch_size=opt.batch_size, ngf=opt.ngf, nglf=opt.nglf, ndf=opt.ndf)
+    model = cycle_identity(args, load_data=False)
+    train_step = model.build_train_step(args, model.g_optim, model.d_optim)
+    patch_X, patch_Y = loader.get_train_set(opt.patch_size, seed=0)
+    patches = iter(tf.data.Dataset.zip((patch_X, patch_Y)).repeat())
+
+    curve = []
+    for step in range(1, opt.train_steps + 1):
+        train_step(*next(patches))
+        if step % opt.eval_every == 0:
+            metrics = tu.evaluate_generators(model.generator_G, model.generator_F, eval_subset)
+            curve.append({'step': step, 'psnr_AtoB': metrics['psnr_AtoB'][0], 'psnr_BtoA': metrics['psnr_BtoA'][0]})
+    return curve
+
+
+def run_foreground(opt):
+    """
+    uniform vs foreground-aware patch sampling on sample data :
+    mean tissue fraction of the patches, share of (almost) air-only patches (tissue < 5 %), sampling throughput,
+    and with --train_steps the eval-subset PSNR curve of a short training run per mode
+    """
+    test_loader = ut.DCMDataLoader(opt.data_path, extension=opt.extension, phase='test')
+    test_loader(opt.test_A.split(','), opt.test_B.split(','))
+    eval_subset = tu.EvalSubset(test_loader, opt.eval_size, 0, opt.batch_size)
+
+    result = {}
+    for mode, fraction in (('uniform', 0.0), ('foreground', opt.min_tissue_fraction)):
+        loader = ut.DCMDataLoader(opt.data_path, batch_size=opt.batch_size, extension=opt.extension,
+                                  min_tissue_fraction=fraction, foreground_hu=opt.foreground_hu)
+        loader(opt.train_A.split(','), opt.train_B.split(','))
+        patch_X, _ = loader.get_train_set(opt.patch_size, seed=0)
+
+        t = time.time()
+        tissue = np.concatenate([np.mean(batch.numpy() > loader.foreground_threshold, axis=(1, 2, 3))
+                                 for batch in patch_X])
+        elapsed = time.time() - t
+        result[mode] = {'min_tissue_fraction': fraction, 'patches_per_sec': len(tissue) / elapsed,
+                        'mean_tissue_fraction': float(np.mean(tissue)),
+                        'air_patch_fraction': float(np.mean(tissue < 0.05))}
+        if opt.train_steps > 0:
+            result[mode]['psnr'] = train_curve(opt, loader, eval_subset)
+    return result
+
+
+# synthetic CT series : elliptic body (soft tissue + gaussian noise) in air
+def synthetic_slice(rng, size, noise):
+    yy, xx = np.mgrid[:size, :size]
+    body = ((yy - size / 2) ** 2 / (size * 0.35) ** 2 + (xx - size / 2) ** 2 / (size * 0.3) ** 2) < 1
+    return np.where(body, 40 + rng.randn(size, size) * noise, -1000).astype(np.float32)  # HU
+
+
+def write_dicom(path, hu, z, series_uid):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPClassUID, ds.SOPInstanceUID = CTImageStorage, meta.MediaStorageSOPInstanceUID
+    ds.Modality, ds.SeriesInstanceUID = 'CT', series_uid
+    ds.Rows, ds.Columns = hu.shape
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+    ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+    ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+    ds.ImagePositionPatient, ds.SliceLocation = [0, 0, z], z
+    ds.PixelData = np.clip(hu + 1024, 0, 4095).astype(np.uint16).tobytes()
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.save_as(path)
+
+
+def make_synthetic_series(root, n_patients, n_slices, size, extension='dcm'):
+    """
+    <root>/SYN<i>_A (noisy, LDCT) and <root>/SYN<i>_B (NDCT) series, dcm or 8-bit png
+    returns (A patient list, B patient list)
+    """
+    rng = np.random.RandomState(0)
+    patients_A, patients_B = [], []
+    for i in range(n_patients):
+        for domain, noise, patients in (('A', 80, patients_A), ('B', 20, patients_B)):
+            patent_no = 'SYN{:03d}_{}'.format(i, domain)
+            patient_dir = os.path.join(root, patent_no)
+            os.makedirs(patient_dir)
+            series_uid = generate_uid()
+            for s in range(n_slices):
+                hu = synthetic_slice(rng, size, noise)
+                path = os.path.join(patient_dir, 'IM{:04d}.{}'.format(s, extension))
+                if extension == 'dcm':
+                    write_dicom(path, hu, float(s * 2.5), series_uid)
+                else:
+                    png = np.clip((hu + 1024) / 16, 0, 255).astype(np.uint8)[..., np.newaxis]
+                    tf.io.write_file(path, tf.io.encode_png(png))
+            patients.append(patent_no)
+    return patients_A, patients_B
+
+
+def slices_per_sec(dataset, n):
+    t = time.time()
+    for _ in dataset:
+        pass
+    return n / (time.time() - t)
+
+
+def run_decode(opt, data_path, patients_A, patients_B, png_path):
+    """slices/sec of DCMDataLoader (LDCT set, train phase) for each decode path"""
+    result = {}
+    settings = [('dcm', data_path, 'dcm', {}),
+                ('dcm_workers', data_path, 'dcm', {'decode_workers': opt.decode_workers}),
+                ('dcm_cache', data_path, 'dcm', {'cache_dir': os.path.join(data_path, 'cache')}),
+                ('png', png_path, 'png', {})]
+    for name, path, extension, kwargs in settings:
+        loader = ut.DCMDataLoader(path, extension=extension, **kwargs)
+        t = time.time()
+        loader(patients_A, patients_B)  # builds the HU cache (dcm_cache)
+        setup = time.time() - t
+        result[name] = {'slices_per_sec': slices_per_sec(loader.LDCT_images, loader.LDCT_images_size),
+                        'setup_sec': setup}
+        if loader.decode_pool is not None:
+            loader.decode_pool.shutdown()
+    return result
+
+
+def run_patches(opt, data_path, patients_A, patients_B):
+    """patches/sec of get_train_set (both domains, HU cache)"""
+    result = {}
+    loader = ut.DCMDataLoader(data_path, batch_size=opt.batch_size, cache_dir=os.path.join(data_path, 'cache'))
+    loader(patients_A, patients_B)
+    for patches_per_slice in (1, 4):
+        patch_X, patch_Y = loader.get_train_set(opt.patch_size, patches_per_slice, seed=0)
+        n = loader.LDCT_images_size * patches_per_slice
+        result['patches_per_slice_{}'.format(patches_per_slice)] = {
+            'patches_per_sec': slices_per_sec(tf.data.Dataset.zip((patch_X, patch_Y)), n)}
+    return result
+
+
+def run_train_grid(opt):
+    """steps/sec of train_step for every (patch_size, batch_size, ngf)"""
+    result = []
+    for patch_size in [int(p) for p in opt.patch_sizes.split(',')]:
+        for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+            for ngf in [int(n) for n in opt.ngfs.split(',')]:
+                args = model_args(patch_size=patch_size, batch_size=batch_size, ngf=ngf, nglf=opt.nglf, ndf=opt.ndf)
+                sec = benchmark_train_step(args, opt.steps, opt.warmup)
+                result.append({'patch_size': patch_size, 'batch_size': batch_size, 'ngf': ngf,
+                               'steps_per_sec': 1 / sec, 'patches_per_sec': batch_size / sec})
+    return result
+
+
+def run_test_phase(opt, data_path, patients_A, patients_B):
+    """slices/sec of cycle_identity.test (both generators, one .npy per slice) with a random-weight checkpoint"""
+    work_dir = tempfile.mkdtemp()
+    args = model_args(phase='test', checkpoint_dir=work_dir, test_npy_save_dir=os.path.join(work_dir, 'test'),
+                      whole_size=opt.size, batch_size=1, ngf=opt.ngf, nglf=opt.nglf, ndf=opt.ndf,
+                      data_path=data_path, extension='dcm', test_patient_no_A=patients_A,
+                      test_patient_no_B=patients_B, test_batch_size=opt.test_batch_size, test_output='slice',
+                      inference_graph='keras', tile_size=0, tile_overlap=32, tile_batch=16, cache_dir=None,
+                      decode_workers=0, decode_queue=0, manifest=None)
+    model = cycle_identity(args)
+    model.ckpt_manager.save()
+    t = time.time()
+    model.test(args)
+    elapsed = time.time() - t
+    n = model.test_image_loader.LDCT_images_size + model.test_image_loader.NDCT_images_size
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return {'slices_per_sec': n / elapsed, 'test_batch_size': opt.test_batch_size}
+
+
+def run_suite(opt):
+    """
+    synthetic dicom / png series in a temp dir -> decode, patch, train step and test phase throughput.
+    the result (with the commit and tensorflow version) is written to opt.output for comparison between commits
+    """
+    root = tempfile.mkdtemp()
+    try:
+        data_path, png_path = os.path.join(root, 'dcm'), os.path.join(root, 'png')
+        patients_A, patients_B = make_synthetic_series(data_path, opt.n_patients, opt.slices, opt.size, 'dcm')
+        make_synthetic_series(png_path, opt.n_patients, opt.slices, opt.size, 'png')
+
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode('utf-8').strip()
+        except OSError:
+            commit = ''
+        result = {'meta': {'commit': commit, 'tensorflow': tf.__version__, 'python': platform.python_version(),
+                           'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                           'size': opt.size, 'slices': opt.slices, 'n_patients': opt.n_patients},
+                  'decode': run_decode(opt, data_path, patients_A, patients_B, png_path),
+                  'patches': run_patches(opt, data_path, patients_A, patients_B),
+                  'train_step': run_train_grid(opt),
+                  'test': run_test_phase(opt, data_path, patients_A, patients_B)}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+BENCHMARKS = {'train_step': run_train_step, 'replica_step': run_replica_step, 'scaling': run_scaling,
+              'memory_step': run_memory_step, 'memory': run_memory, 'foreground': run_foreground,
+              'precision_step': run_precision_step, 'precision': run_precision,
+              'suite': run_suite}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic-data throughput benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('--patch_size', dest='patch_size', type=int, default=56, help='image patch size, h=w')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=10, help='batch size')
+    parser.add_argument('--ngf', dest='ngf', type=int, default=128, help='# of gen filters in first conv layer')
+    parser.add_argument('--nglf', dest='nglf', type=int, default=15, help='# of gen filters in last conv layer')
+    parser.add_argument('--ndf', dest='ndf', type=int, default=64, help='# of discri filters in first conv layer')
+    parser.add_argument('--steps', dest='steps', type=int, default=20, help='# of timed steps')
+    parser.add_argument('--warmup', dest='warmup', type=int, default=3, help='# of untimed steps')
+    parser.add_argument('--cpu_replicas', dest='cpu_replicas', type=int, default=1,
+                        help='# of logical CPU devices (replica_step)')
+    parser.add_argument('--replicas', dest='replicas', default='1,2,4', help='replica counts (scaling)')
+    parser.add_argument('--recompute', dest='recompute', type=ut.ParseBoolean, default=False,
+                        help='recompute the generator module activations (memory_step)')
+    parser.add_argument('--patch_sizes', dest='patch_sizes', default='56,128,256', help='patch sizes (memory)')
+    parser.add_argument('--batch_sizes', dest='batch_sizes', default='4,10', help='batch sizes (memory)')
+    parser.add_argument('--data_path', dest='data_path', help='dicom dir (foreground)')
+    parser.add_argument('--extension', dest='extension', default='dcm', help='file extension (foreground)')
+    parser.add_argument('--train_A', dest='train_A', help='LDCT train patients, comma separated (foreground)')
+    parser.add_argument('--train_B', dest='train_B', help='NDCT train patients, comma separated (foreground)')
+    parser.add_argument('--test_A', dest='test_A', help='LDCT test patients, comma separated (foreground)')
+    parser.add_argument('--test_B', dest='test_B', help='NDCT test patients, comma separated (foreground)')
+    parser.add_argument('--min_tissue_fraction', dest='min_tissue_fraction', type=float, default=0.5,
+                        help='min foreground fraction of a patch (foreground)')
+    parser.add_argument('--foreground_hu', dest='foreground_hu', type=int, default=-500,
+                        help='foreground threshold in HU (foreground)')
+    parser.add_argument('--train_steps', dest='train_steps', type=int, default=0,
+                        help='# of train steps per sampling mode, 0 : sampling statistics only (foreground)')
+    parser.add_argument('--eval_every', dest='eval_every', type=int, default=20, help='eval interval (foreground)')
+    parser.add_argument('--eval_size', dest='eval_size', type=int, default=16, help='# of eval slices (foreground)')
+    parser.add_argument('--slices', dest='slices', type=int, default=16, help='# of slices per series (suite)')
+    parser.add_argument('--n_patients', dest='n_patients', type=int, default=2,
+                        help='# of synthetic patients per domain (suite)')
+    parser.add_argument('--ngfs', dest='ngfs', default='32,128', help='ngf values of the train step grid (suite)')
+    parser.add_argument('--decode_workers', dest='decode_workers', type=int, default=2,
+                        help='# of decode worker processes (suite)')
+    parser.add_argument('--test_batch_size', dest='test_batch_size', type=int, default=1,
+                        help='# of slices per generator call in the test phase (suite)')
+    parser.add_argument('--size', dest='size', type=int, default=512,
+                        help='synthetic slice size (suite), parity input size (precision)')
+    parser.add_argument('--precision', dest='precision', default='float32', help='precision policy (precision_step)')
+    parser.add_argument('--precisions', dest='precisions', default='float32,mixed_bfloat16,mixed_float16',
+                        help='precision policies, the first one is the parity reference (precision)')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='result json path (suite), generator output npz path (precision_step)')
+    opt = parser.parse_args()
+
+    result = BENCHMARKS[opt.benchmark](opt)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,15 +13,34 @@ All rights reserved.
 from __future__ import division
 import os
 import time
+import shutil
 import tensorflow as tf
 import numpy as np
 from collections import namedtuple
 import cycle_identity_module as md
 import inout_util as ut
+import inference_util as iu
+import train_util as tu
 
 
 class cycle_identity(object):
-    def __init__(self, args):
+    # loss summary : (name scope, summary name, loss key)
+    LOSS_SUMMARY = [("Generator_loss", "1_G_loss", 'G_loss'),
+                    ("Generator_loss", "2_cycle_loss", 'cycle_loss'),
+                    ("Generator_loss", "3_identity_loss", 'identity_loss'),
+                    ("Generator_loss", "4_G_loss_X2Y", 'G_loss_X2Y'),
+                    ("Generator_loss", "5_G_loss_Y2X", 'G_loss_Y2X'),
+                    ("Discriminator_loss", "1_D_loss", 'D_loss'),
+                    ("Discriminator_loss", "2_D_loss_Y", 'D_loss_Y'),
+                    ("Discriminator_loss", "3_D_loss_GX", 'D_loss_GX'),
+                    ("Discriminator_loss", "4_D_loss_X", 'D_loss_X'),
+                    ("Discriminator_loss", "5_D_loss_FY", 'D_loss_FY')]
+
+    def __init__(self, args, load_data=True):
+        # distribution strategy (default strategy : one device)
+        self.strategy = tu.get_strategy(args.distribute, args.cpu_replicas)
+        self.is_chief = tu.is_chief(self.strategy)
+
         # save directory
         if args.taskID:
             self.taskID = args.taskID
@@ -40,6 +59,72 @@ class cycle_identity(object):
         """
         load images
         """
+        if load_data:
+            self.load_images(args)
+
+        # keras precision policy of the four models (checkpoints are the same : float32 variables)
+        md.set_precision(args.precision)
+
+        with self.strategy.scope():
+            """
+            build model
+            """
+            if args.phase == 'train':
+                input_shape = (args.patch_size, args.patch_size, args.img_channel)
+            else:
+                input_shape = (args.whole_size, args.whole_size, args.img_channel)
+            # Generator (fully convolutional : patch, tile and whole image of any size)
+            generator_shape = (None, None, args.img_channel)
+            self.generator_G = md.generator(generator_shape, self.options, name="generatorX2Y")
+            self.generator_F = md.generator(generator_shape, self.options, name="generatorY2X")
+            # Discriminator
+            self.discriminator_X = md.discriminator(input_shape, self.options, name="discriminatorX")
+            self.discriminator_Y = md.discriminator(input_shape, self.options, name="discriminatorY")
+
+            # optimizers used by the train step (saved / restored with the checkpoint)
+            self.g_optim = tf.keras.optimizers.Adam(learning_rate=args.lr, beta_1=args.beta1, beta_2=args.beta2)
+            self.d_optim = tf.keras.optimizers.Adam(learning_rate=args.lr, beta_1=args.beta1, beta_2=args.beta2)
+            # one optimizer per model pair : the slots of both models are created now, since the optimizer
+            # only accepts the variables it was built with (the train step applies G / F and X / Y separately)
+            if hasattr(self.g_optim, 'build'):
+                self.g_optim.build(self.generator_G.trainable_variables + self.generator_F.trainable_variables)
+                self.d_optim.build(self.discriminator_X.trainable_variables +
+                                   self.discriminator_Y.trainable_variables)
+
+            """
+            set check point
+            """
+            self.ckpt = tf.train.Checkpoint(step=tf.Variable(0, dtype=tf.int64), generator_G=self.generator_G,
+                                            generator_F=self.generator_F,
+                                            discriminator_X=self.discriminator_X, discriminator_Y=self.discriminator_Y,
+                                            generator_optimizer=self.g_optim, discriminator_optimizer=self.d_optim,
+                                            best_psnr=tf.Variable(-np.inf, dtype=tf.float32),
+                                            # input pipeline position : epoch, steps done in the epoch, data seed
+                                            epoch=tf.Variable(0, dtype=tf.int64),
+                                            epoch_step=tf.Variable(0, dtype=tf.int64),
+                                            seed=tf.Variable(-1, dtype=tf.int64))
+        # last keep_checkpoints checkpoints, and the keep_best best by evaluation PSNR in checkpoint_dir/best
+        # (every worker takes part in the save, only the chief writes to checkpoint_dir)
+        checkpoint_dir = self.checkpoint_dir if self.is_chief else tu.worker_dir(self.checkpoint_dir, self.strategy)
+        self.save_dir = checkpoint_dir
+        self.ckpt_manager = tf.train.CheckpointManager(self.ckpt, checkpoint_dir, max_to_keep=args.keep_checkpoints,
+                                                       checkpoint_name='cycle_identity.model')
+        self.best_manager = tf.train.CheckpointManager(self.ckpt, os.path.join(checkpoint_dir, 'best'),
+                                                       max_to_keep=args.keep_best,
+                                                       checkpoint_name='cycle_identity.model')
+        # background write from a snapshot of the variables
+        self.ckpt_options = tu.checkpoint_options(args.async_checkpoint and args.distribute != 'multi_worker')
+        """
+        Summary writer (TensorBoard), chief worker only
+        """
+        if self.is_chief:
+            self.writer = tf.summary.create_file_writer(self.log_dir)
+        else:
+            self.writer = tf.summary.create_noop_writer()
+        # step losses, accumulated in the train step and written every summary_freq steps
+        self.loss_metrics = tu.LossAccumulator(self.LOSS_SUMMARY, stats=args.summary_stats)
+
+    def load_images(self, args):
         print('data load... dicom -> numpy')
 
         t1 = time.time()
@@ -47,139 +132,177 @@ class cycle_identity(object):
             self.train_image_loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size,
                                                        patch_size=args.patch_size,
                                                        image_max=args.img_vmax, image_min=args.img_vmin,
-                                                       batch_size=args.batch_size, extension=args.extension)
+                                                       batch_size=args.batch_size, extension=args.extension,
+                                                       cache_dir=args.cache_dir, decode_workers=args.decode_workers,
+                                                       decode_queue=args.decode_queue, manifest=args.manifest,
+                                                       min_tissue_fraction=args.min_tissue_fraction,
+                                                       foreground_hu=args.foreground_hu)
+            # test phase loader : LDCT / NDCT test slices in paired (not shuffled) order
             self.test_image_loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size,
                                                       patch_size=args.patch_size,
                                                       image_max=args.img_vmax, image_min=args.img_vmin,
-                                                      batch_size=args.batch_size, extension=args.extension)
+                                                      batch_size=args.batch_size, extension=args.extension,
+                                                      phase='test', cache_dir=args.cache_dir,
+                                                      decode_workers=args.decode_workers,
+                                                      decode_queue=args.decode_queue, manifest=args.manifest)
             self.train_image_loader(args.train_patient_no_A, args.train_patient_no_B)
             self.test_image_loader(args.test_patient_no_A, args.test_patient_no_B)
-            self.patch_X_set, self.patch_Y_set = self.train_image_loader.get_train_set(args.patch_size)
-            self.whole_X_set, self.whole_Y_set = self.test_image_loader.get_test_set()
+            self.whole_X_set, self.whole_Y_set = self.test_image_loader.get_test_set(args.eval_batch_size)
+            # fixed evaluation subset, decoded once
+            self.eval_subset = tu.EvalSubset(self.test_image_loader, args.eval_size,
+                                             0 if args.seed is None else args.seed, args.eval_batch_size)
             print('data load complete !!!, {}\n'.format(time.time() - t1))
             print('N_train : {}, N_test : {}'.format(self.train_image_loader.LDCT_images_size, self.test_image_loader.LDCT_images_size))
         else:
             self.test_image_loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size,
                                                       patch_size=args.patch_size, image_max=args.img_vmax,
                                                       image_min=args.img_vmin, batch_size=args.batch_size,
-                                                      extension=args.extension, phase=args.phase)
+                                                      extension=args.extension, phase=args.phase,
+                                                      cache_dir=args.cache_dir, decode_workers=args.decode_workers,
+                                                      decode_queue=args.decode_queue, manifest=args.manifest)
             self.test_image_loader(args.test_patient_no_A, args.test_patient_no_B)
-            self.whole_X_set, self.whole_Y_set = self.test_image_loader.get_test_set()
+            self.whole_X_set, self.whole_Y_set = self.test_image_loader.get_test_set(args.test_batch_size)
             print('data load complete !!!, {}, N_test : {}'.format(time.time() - t1, self.test_image_loader.LDCT_images_size))
 
+    def build_train_step(self, args, g_optim, d_optim):
         """
-        build model
+        returns train_step(patch_X, patch_Y), the step losses are accumulated in self.loss_metrics
+        patch_X, patch_Y : global batch, or per replica values of a distributed dataset (self.strategy)
+        args.jit : XLA compiled step with a fixed input signature (needs drop_remainder batches),
+                   one gradient computation per loss over the generator / discriminator variables
         """
-        if args.phase == 'train':
-            input_shape = (args.patch_size, args.patch_size, args.img_channel)
+        # args.recompute : gen_module activations are recomputed in backprop instead of kept on the tape
+        if args.recompute:
+            generator_G = md.recompute_generator(self.generator_G)
+            generator_F = md.recompute_generator(self.generator_F)
         else:
-            input_shape = (args.whole_size, args.whole_size, args.img_channel)
-        # Generator
-        self.generator_G = md.generator(input_shape, self.options, name="generatorX2Y")
-        self.generator_F = md.generator(input_shape, self.options, name="generatorY2X")
-        # Discriminator
-        self.discriminator_X = md.discriminator(input_shape, self.options, name="discriminatorX")
-        self.discriminator_Y = md.discriminator(input_shape, self.options, name="discriminatorY")
+            generator_G, generator_F = self.generator_G, self.generator_F
+
+        # mixed_float16 : dynamic loss scaling, the wrapped optimizers update the same (checkpointed) slots
+        loss_scale = args.precision == 'mixed_float16'
+        if loss_scale:
+            with self.strategy.scope():
+                g_optim = tf.keras.mixed_precision.LossScaleOptimizer(g_optim)
+                d_optim = tf.keras.mixed_precision.LossScaleOptimizer(d_optim)
+
+        # scaled(): inside the tape, gradients(): of a scaled loss, unscaled with the loss scale of this step
+        def scaled(optim, loss):
+            return optim.get_scaled_loss(loss) if loss_scale else loss
+
+        def gradients(tape, optim, loss, variables):
+            grads = tape.gradient(loss, variables)
+            return optim.get_unscaled_gradients(grads) if loss_scale else grads
+
+        def forward(patch_X, patch_Y):
+            #### Forwarding
+            # Generator forward
+            G_X = generator_G(patch_X)
+            F_GX = generator_F(G_X)
+            F_Y = generator_F(patch_Y)
+            G_FY = generator_G(F_Y)
+
+            G_Y = generator_G(patch_Y)  # IDENT
+            F_X = generator_F(patch_X)  # IDENT
+
+            # Discriminator forward
+            D_GX = self.discriminator_Y(G_X)
+            D_FY = self.discriminator_X(F_Y)
+            D_Y = self.discriminator_Y(patch_Y)
+            D_X = self.discriminator_X(patch_X)
+
+            #### Loss
+            # generator loss
+            cycle_loss = md.cycle_loss(patch_X, F_GX, patch_Y, G_FY, args.L1_lambda)
+            identity_loss = md.identity_loss(patch_X, G_Y, patch_Y, F_X, args.L1_gamma)
+            G_loss_X2Y = md.least_square(D_GX, tf.ones_like(D_GX))
+            G_loss_Y2X = md.least_square(D_FY, tf.ones_like(D_FY))
+
+            G_loss = G_loss_X2Y + G_loss_Y2X + cycle_loss + identity_loss  # GAN LOSS
+
+            # discriminator loss
+            D_loss_patch_Y = md.least_square(D_Y, tf.ones_like(D_Y))
+            D_loss_patch_GX = md.least_square(D_GX, tf.zeros_like(D_GX))
+            D_loss_patch_X = md.least_square(D_X, tf.ones_like(D_X))
+            D_loss_patch_FY = md.least_square(D_FY, tf.zeros_like(D_FY))
+
+            D_loss_Y = (D_loss_patch_Y + D_loss_patch_GX)
+            D_loss_X = (D_loss_patch_X + D_loss_patch_FY)
+            D_loss = (D_loss_X + D_loss_Y) / 2
+
+            return {'G_loss': G_loss, 'cycle_loss': cycle_loss, 'identity_loss': identity_loss,
+                    'G_loss_X2Y': G_loss_X2Y, 'G_loss_Y2X': G_loss_Y2X,
+                    'D_loss': D_loss, 'D_loss_Y': D_loss_patch_Y, 'D_loss_GX': D_loss_patch_GX,
+                    'D_loss_X': D_loss_patch_X, 'D_loss_FY': D_loss_patch_FY}
+
+        # losses are means over the replica batch, gradients are summed over the replicas
+        replicas = self.strategy.num_replicas_in_sync
+
+        if not args.jit:
+            def replica_step(patch_X, patch_Y):
+                with tf.GradientTape(persistent=True) as tape:
+                    losses = forward(patch_X, patch_Y)
+                    G_loss = scaled(g_optim, losses['G_loss'] / replicas)
+                    D_loss = scaled(d_optim, losses['D_loss'] / replicas)
+
+                # get gradients values from tape
+                generator_g_gradients = gradients(tape, g_optim, G_loss, self.generator_G.trainable_variables)
+                generator_f_gradients = gradients(tape, g_optim, G_loss, self.generator_F.trainable_variables)
+
+                discriminator_x_gradients = gradients(tape, d_optim, D_loss, self.discriminator_X.trainable_variables)
+                discriminator_y_gradients = gradients(tape, d_optim, D_loss, self.discriminator_Y.trainable_variables)
+                # training
+                g_optim.apply_gradients(zip(generator_g_gradients,
+                                            self.generator_G.trainable_variables))
+
+                g_optim.apply_gradients(zip(generator_f_gradients,
+                                            self.generator_F.trainable_variables))
+
+                d_optim.apply_gradients(zip(discriminator_x_gradients,
+                                            self.discriminator_X.trainable_variables))
+
+                d_optim.apply_gradients(zip(discriminator_y_gradients,
+                                            self.discriminator_Y.trainable_variables))
+                return losses
+        else:
+            # XLA compiled step
+            if replicas > 1:
+                raise ValueError('--jit is not supported with more than one replica')
+            g_vars = self.generator_G.trainable_variables + self.generator_F.trainable_variables
+            d_vars = self.discriminator_X.trainable_variables + self.discriminator_Y.trainable_variables
+            patch_spec = tf.TensorSpec([args.batch_size, args.patch_size, args.patch_size, args.img_channel],
+                                       tf.float32)
+
+            @tf.function(input_signature=[patch_spec, patch_spec], jit_compile=True)
+            def replica_step(patch_X, patch_Y):
+                with tf.GradientTape(persistent=True) as tape:
+                    losses = forward(patch_X, patch_Y)
+                    G_loss = scaled(g_optim, losses['G_loss'])
+                    D_loss = scaled(d_optim, losses['D_loss'])
+                g_gradients = gradients(tape, g_optim, G_loss, g_vars)
+                d_gradients = gradients(tape, d_optim, D_loss, d_vars)
+                g_optim.apply_gradients(zip(g_gradients, g_vars))
+                d_optim.apply_gradients(zip(d_gradients, d_vars))
+                return losses
 
-        """
-        set check point
-        """
-        self.ckpt = tf.train.Checkpoint(step=tf.Variable(0, dtype=tf.int64), generator_G=self.generator_G,
-                                        generator_F=self.generator_F,
-                                        discriminator_X=self.discriminator_X, discriminator_Y=self.discriminator_Y,
-                                        generator_optimizer=tf.keras.optimizers.Adam(learning_rate=args.lr,
-                                                                                     beta_1=args.beta1,
-                                                                                     beta_2=args.beta2),
-                                        discriminator_optimizer=tf.keras.optimizers.Adam(learning_rate=args.lr,
-                                                                                         beta_1=args.beta1,
-                                                                                         beta_2=args.beta2))
-        """
-        Summary writer (TensorBoard)
-        """
-        self.writer = tf.summary.create_file_writer(self.log_dir)
+        @tf.function
+        def train_step(patch_X, patch_Y):
+            losses = self.strategy.run(replica_step, args=(patch_X, patch_Y))
+            losses = {key: self.strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+                      for key, loss in losses.items()}
+            self.loss_metrics.update(losses)
+            return losses
+
+        return train_step
 
     def train(self, args):
-        @tf.function
-        def train_step(patch_X, patch_Y, g_optim, d_optim, step):
-            with tf.GradientTape(persistent=True) as tape, self.writer.as_default():
-                #### Forwarding
-                # Generator forward
-                G_X = self.generator_G(patch_X)
-                F_GX = self.generator_F(G_X)
-                F_Y = self.generator_F(patch_Y)
-                G_FY = self.generator_G(F_Y)
-
-                G_Y = self.generator_G(patch_Y)  # IDENT
-                F_X = self.generator_F(patch_X)  # IDENT
-
-                # Discriminator forward
-                D_GX = self.discriminator_Y(G_X)
-                D_FY = self.discriminator_X(F_Y)
-                D_Y = self.discriminator_Y(patch_Y)
-                D_X = self.discriminator_X(patch_X)
-
-                #### Loss
-                # generator loss
-                cycle_loss = md.cycle_loss(patch_X, F_GX, patch_Y, G_FY, args.L1_lambda)
-                identity_loss = md.identity_loss(patch_X, G_Y, patch_Y, F_X, args.L1_gamma)
-                G_loss_X2Y = md.least_square(D_GX, tf.ones_like(D_GX))
-                G_loss_Y2X = md.least_square(D_FY, tf.ones_like(D_FY))
-
-                G_loss = G_loss_X2Y + G_loss_Y2X + cycle_loss + identity_loss  # GAN LOSS
-
-                # discriminator loss
-                D_loss_patch_Y = md.least_square(D_Y, tf.ones_like(D_Y))
-                D_loss_patch_GX = md.least_square(D_GX, tf.zeros_like(D_GX))
-                D_loss_patch_X = md.least_square(D_X, tf.ones_like(D_X))
-                D_loss_patch_FY = md.least_square(D_FY, tf.zeros_like(D_FY))
-
-                D_loss_Y = (D_loss_patch_Y + D_loss_patch_GX)
-                D_loss_X = (D_loss_patch_X + D_loss_patch_FY)
-                D_loss = (D_loss_X + D_loss_Y) / 2
-
-                #### loss summary
-                # generator
-                with tf.name_scope("Generator_loss"):
-                    tf.summary.scalar(name="1_G_loss", data=G_loss, step=step)
-                    tf.summary.scalar(name="2_cycle_loss", data=cycle_loss, step=step)
-                    tf.summary.scalar(name="3_identity_loss", data=identity_loss, step=step)
-                    tf.summary.scalar(name="4_G_loss_X2Y", data=G_loss_X2Y, step=step)
-                    tf.summary.scalar(name="5_G_loss_Y2X", data=G_loss_Y2X, step=step)
-
-                # discriminator
-                with tf.name_scope("Discriminator_loss"):
-                    tf.summary.scalar(name="1_D_loss", data=D_loss, step=step)
-                    tf.summary.scalar(name="2_D_loss_Y", data=D_loss_patch_Y, step=step)
-                    tf.summary.scalar(name="3_D_loss_GX", data=D_loss_patch_GX, step=step)
-                    tf.summary.scalar(name="4_D_loss_X", data=D_loss_patch_X, step=step)
-                    tf.summary.scalar(name="5_D_loss_FY", data=D_loss_patch_FY, step=step)
-
-            # get gradients values from tape
-            generator_g_gradients = tape.gradient(G_loss,
-                                                  self.generator_G.trainable_variables)
-            generator_f_gradients = tape.gradient(G_loss,
-                                                  self.generator_F.trainable_variables)
-
-            discriminator_x_gradients = tape.gradient(D_loss,
-                                                      self.discriminator_X.trainable_variables)
-            discriminator_y_gradients = tape.gradient(D_loss,
-                                                      self.discriminator_Y.trainable_variables)
-            # training
-            g_optim.apply_gradients(zip(generator_g_gradients,
-                                        self.generator_G.trainable_variables))
-
-            g_optim.apply_gradients(zip(generator_f_gradients,
-                                        self.generator_F.trainable_variables))
-
-            d_optim.apply_gradients(zip(discriminator_x_gradients,
-                                        self.discriminator_X.trainable_variables))
-
-            d_optim.apply_gradients(zip(discriminator_y_gradients,
-                                        self.discriminator_Y.trainable_variables))
+        train_step = self.build_train_step(args, self.g_optim, self.d_optim)
 
         # #########################################
         # summary train-sample image during training
         def check_train_sample(patch_X_batch, patch_Y_batch, step):
+            # batch of the first (local) replica
+            patch_X_batch = self.strategy.experimental_local_results(patch_X_batch)[0]
+            patch_Y_batch = self.strategy.experimental_local_results(patch_Y_batch)[0]
             patch_X = tf.expand_dims(patch_X_batch[0], axis=0)  # Select the first patched image of batch
             patch_Y = tf.expand_dims(patch_Y_batch[0], axis=0)  # And expand dimension to (1, patch_size, patch_size, 1)
             G_X = self.generator_G(patch_X, training=False)  # Inference mode,
@@ -209,20 +332,16 @@ class cycle_identity(object):
         # #########################################
         # summary test-sample image during training
         def check_test_sample(step):
-            # take arbitrary sample in test_set
-            buffer_size = 50
-            sample_whole_X = tf.constant(list(self.whole_X_set.shuffle(buffer_size).take(1).as_numpy_iterator())[0])
-            sample_whole_Y = tf.constant(list(self.whole_Y_set.shuffle(buffer_size).take(1).as_numpy_iterator())[0])
+            # PSNR / SSIM over the fixed evaluation subset
+            metrics = tu.evaluate_generators(self.generator_G, self.generator_F, self.eval_subset)
+            tu.write_eval_summary(self.writer, "PSNR", metrics, step)
+
+            # first slice of the evaluation subset
+            sample_whole_X = tf.constant(self.eval_subset.X[:1])
+            sample_whole_Y = tf.constant(self.eval_subset.Y[:1])
             G_X = self.generator_G(sample_whole_X, training=False)
             F_Y = self.generator_F(sample_whole_Y, training=False)
 
-            with self.writer.as_default():
-                with tf.name_scope("PSNR"):
-                    tf.summary.scalar(name="1_psnr", step=step,
-                                      data=ut.tf_psnr(sample_whole_X, sample_whole_Y, 2))  # -1 ~ 1
-                    tf.summary.scalar(name="2_psnr_AtoB", step=step, data=ut.tf_psnr(sample_whole_Y, G_X, 2))
-                    tf.summary.scalar(name="2_psnr_BtoA", step=step, data=ut.tf_psnr(sample_whole_X, F_Y, 2))
-
             # re-scale for Tensorboard
             sample_whole_X = ut.rescale_arr(data=sample_whole_X,
                                             i_min=tf.math.reduce_min(sample_whole_X),
@@ -245,6 +364,7 @@ class cycle_identity(object):
                     tf.summary.image(name="sample_whole_Y", step=step, data=sample_whole_Y, max_outputs=1)
                     tf.summary.image(name="G(sample_whole_X)", step=step, data=G_X, max_outputs=1)
                     tf.summary.image(name="F(sample_whole_Y)", step=step, data=F_Y, max_outputs=1)
+            return metrics
 
         # #############################
         # pre-trained model load
@@ -258,47 +378,153 @@ class cycle_identity(object):
         print('Start point : step : {}'.format(current_step))
 
         # 한 에폭을 진행하는데 필요한 스탭 계산
-        steps_per_epoch = min(self.train_image_loader.LDCT_images_size, self.train_image_loader.NDCT_images_size) // args.batch_size
-
-        # decay learning rate
-        d_optim = tf.keras.optimizers.Adam(learning_rate=args.lr, beta_1=args.beta1, beta_2=args.beta2)
-        g_optim = tf.keras.optimizers.Adam(learning_rate=args.lr, beta_1=args.beta1, beta_2=args.beta2)
+        steps_per_epoch = min(self.train_image_loader.LDCT_images_size, self.train_image_loader.NDCT_images_size) * args.patches_per_slice // args.batch_size
+        if args.pipeline == 'streaming':
+            # each domain is resampled independently : by default an epoch covers the larger domain once
+            steps_per_epoch = args.steps_per_epoch if args.steps_per_epoch > 0 else -(-max(
+                self.train_image_loader.LDCT_images_size, self.train_image_loader.NDCT_images_size) * args.patches_per_slice // args.batch_size)
+
+        # data seed of the run : kept in the checkpoint, a resumed run continues the same epoch orders
+        if int(self.ckpt.seed.numpy()) < 0:
+            seed = args.seed if args.seed is not None else np.random.randint(2 ** 31 - 1)
+            # multi_worker : every worker takes the chief's seed, the data shards need the same epoch orders
+            self.ckpt.seed.assign(tu.broadcast_from_chief(self.strategy, seed, self.is_chief))
+        seed = int(self.ckpt.seed.numpy())
+        start_epoch, start_epoch_step = int(self.ckpt.epoch.numpy()), int(self.ckpt.epoch_step.numpy())
+        print('Start point : epoch : {}, step in epoch : {}, seed : {}'.format(start_epoch, start_epoch_step, seed))
+
+        # per-stage timing (printed every print_freq), structured step log, profiler trace window
+        timer, window_timer = tu.StageTimer(), tu.StageTimer()
+        step_log = tu.StepLogger(args.step_log if self.is_chief else None)
+        profiler = tu.ProfilerWindow(args.profile_steps if self.is_chief else '', self.log_dir)
 
         start_time = current_time = time.time()
-        for epoch in range(args.epoch):
-            step_count = 0  # for counting steps per epoch
-            for patch_X, patch_Y in tf.data.Dataset.zip((self.patch_X_set, self.patch_Y_set)):
-                train_step(patch_X, patch_Y, g_optim, d_optim, self.ckpt.step)  # one step
+        for epoch in range(start_epoch, args.epoch):
+            step_count = start_epoch_step if epoch == start_epoch else 0  # for counting steps per epoch
+            # epoch dataset, without the slices of the steps done before a restart
+            skip_slices = step_count * args.batch_size // args.patches_per_slice
+
+            # num_shards > 1 : the slices of one worker, sharded before decoding, batch_size : per replica batch
+            def epoch_dataset(num_shards=1, shard_index=0, batch_size=args.batch_size):
+                if args.pipeline == 'streaming':
+                    patch_X_set, patch_Y_set = self.train_image_loader.get_stream_set(
+                        args.patch_size, args.patches_per_slice, seed, epoch, args.cycle_length, args.shuffle_buffer,
+                        skip_slices, num_shards, shard_index, batch_size)
+                    batches_per_step = args.batch_size // (num_shards * batch_size)
+                    epoch_set = tf.data.Dataset.zip((patch_X_set, patch_Y_set)).take(
+                        (steps_per_epoch - step_count) * batches_per_step)
+                else:
+                    patch_X_set, patch_Y_set = self.train_image_loader.get_train_set(
+                        args.patch_size, args.patches_per_slice, seed, drop_remainder=args.jit, epoch=epoch,
+                        skip_slices=skip_slices, num_shards=num_shards, shard_index=shard_index,
+                        batch_size=batch_size)
+                    epoch_set = tf.data.Dataset.zip((patch_X_set, patch_Y_set))
+                # prepared while the previous step runs
+                return epoch_set.prefetch(tf.data.experimental.AUTOTUNE)
+
+            if tu.num_workers(self.strategy) > 1:
+                # multi_worker : every worker decodes only its shard of the epoch, per replica batches
+                train_set = self.strategy.distribute_datasets_from_function(
+                    lambda context: epoch_dataset(context.num_input_pipelines, context.input_pipeline_id,
+                                                  context.get_per_replica_batch_size(args.batch_size)))
+            else:
+                # global batches, split over the local replicas
+                train_set = self.strategy.experimental_distribute_dataset(epoch_dataset())
+            # --data_queue : batches are fetched by a background thread, the queue depth shows the input headroom
+            train_iter = tu.QueuedIterator(train_set, args.data_queue) if args.data_queue > 0 else iter(train_set)
+
+            while True:
+                profiler.update(current_step)
+                with profiler.trace(current_step):
+                    queue_depth = train_iter.depth() if args.data_queue > 0 else None
+                    with timer('data_wait'):
+                        try:
+                            patch_X, patch_Y = next(train_iter)
+                        except StopIteration:
+                            break
+                    with timer('step'):
+                        losses = train_step(patch_X, patch_Y)  # one step
+                        if step_log:
+                            # wait for the step, otherwise the device time is counted in a later stage
+                            losses = {key: float(loss) for key, loss in losses.items()}
                 # update step counters
                 current_step += 1
                 step_count += 1
                 self.ckpt.step.assign_add(1)
+                self.ckpt.epoch_step.assign(step_count)
+
+                if current_step % args.summary_freq == 0:
+                    # loss summary of the last summary_freq steps
+                    with timer('summary'):
+                        self.loss_metrics.write(self.writer, current_step)
 
                 if current_step % args.print_freq == 0:
                     tmp_time = time.time()
                     print(("Epoch: {} {}/{} time: {:.3f}s per step".format(epoch, step_count, steps_per_epoch, (tmp_time - current_time) / args.print_freq)))
                     current_time = tmp_time
-                    # summary with sample images
+                    # summary with sample images (no-op writer on the other workers)
                     print("Sample summary...")
-                    check_train_sample(patch_X, patch_Y, current_step)
-                    check_test_sample(current_step)
+                    with timer('summary'):
+                        check_train_sample(patch_X, patch_Y, current_step)
+                    with timer('eval'):
+                        metrics = check_test_sample(current_step)
                     print("done")
+                    # best checkpoint : mean PSNR of both directions on the evaluation subset
+                    psnr = (metrics['psnr_AtoB'][0] + metrics['psnr_BtoA'][0]) / 2
+                    if psnr > self.ckpt.best_psnr.numpy():
+                        self.ckpt.best_psnr.assign(psnr)
+                        with timer('checkpoint'):
+                            self.save(args, current_step, best=True)
+
+                if self.is_chief and args.full_eval_freq > 0 and current_step % args.full_eval_freq == 0:
+                    # PSNR / SSIM over all test slices, streamed from the test loader
+                    t = time.time()
+                    with timer('eval'):
+                        metrics = tu.evaluate_generators(self.generator_G, self.generator_F,
+                                                         tf.data.Dataset.zip((self.whole_X_set, self.whole_Y_set)))
+                        tu.write_eval_summary(self.writer, "PSNR_full", metrics, current_step)
+                    print("Full evaluation : psnr_AtoB {:.3f}, psnr_BtoA {:.3f}, {:.3f}s".format(
+                        metrics['psnr_AtoB'][0], metrics['psnr_BtoA'][0], time.time() - t))
 
                 if current_step % args.save_freq == 0:
                     # checkpoint
-                    self.save(args, current_step)
-
-    # save model
-    def save(self, args, step):
-        save_file_name = "cycle_identity.model." + "step_" + str(step)
-        self.checkpoint_dir = os.path.join('.', self.checkpoint_dir)
-
-        if not os.path.exists(self.checkpoint_dir):
-            os.makedirs(self.checkpoint_dir)
-
-        path = os.path.abspath(self.ckpt.save(os.path.join(self.checkpoint_dir, save_file_name)))
-
-        print("Save check point : " + path)
+                    with timer('checkpoint'):
+                        self.save(args, current_step)
+
+                # stage seconds of this step -> step log, accumulated for the print_freq breakdown
+                seconds = timer.lap()
+                for stage, sec in seconds.items():
+                    window_timer.add(stage, sec)
+                if step_log:
+                    step_log.write({'step': current_step, 'epoch': epoch, 'time': time.time(),
+                                    'seconds': seconds, 'queue_depth': queue_depth, 'losses': losses})
+                if current_step % args.print_freq == 0:
+                    window = window_timer.seconds
+                    window_timer = tu.StageTimer()
+                    print("Stage time per step : " + ", ".join("{} {:.3f}s".format(stage, window[stage] / args.print_freq)
+                                                                for stage in sorted(window) if stage != 'total'))
+
+            self.ckpt.epoch.assign_add(1)
+            self.ckpt.epoch_step.assign(0)
+
+        # remaining steps of the last summary window
+        self.loss_metrics.write(self.writer, current_step)
+        self.writer.flush()
+        profiler.close()
+        step_log.close()
+        # wait for the background checkpoint write
+        if hasattr(self.ckpt, 'sync'):
+            self.ckpt.sync()
+
+    # save model (in the background with --async_checkpoint, old checkpoints are deleted by the managers)
+    def save(self, args, step, best=False):
+        manager = self.best_manager if best else self.ckpt_manager
+        path = manager.save(checkpoint_number=step, options=self.ckpt_options)
+        if not self.is_chief:
+            # scratch copy of a non-chief worker (synchronous save with multi_worker)
+            shutil.rmtree(self.save_dir, ignore_errors=True)
+            return
+        print("Save {}check point : {}".format("best " if best else "", os.path.abspath(path)))
 
     # load model    
     def load(self):
@@ -321,21 +547,78 @@ class cycle_identity(object):
             print(" [!] Load failed...")
             return
 
+        # tiles are only independent of the other tiles of their batch without batch statistics
+        inference_graph = args.inference_graph
+        if args.tile_size > 0 and inference_graph != 'folded':
+            print(" [!] --tile_size needs the batch norm folded generator, inference graph : {} -> folded".format(
+                inference_graph))
+            inference_graph = 'folded'
+        # only the folded graph gives the output of a slice whatever it is batched with
+        if inference_graph != 'folded' and args.test_batch_size > 1:
+            print(" [!] {} inference graph normalizes with batch statistics, test_batch_size {} -> 1 "
+                  "(only --inference_graph folded can batch slices)".format(inference_graph, args.test_batch_size))
+            self.whole_X_set, self.whole_Y_set = self.test_image_loader.get_test_set(1)
+
+        # inference graph : fused pad + conv (, folded batch norm)
+        if inference_graph != 'keras':
+            fold_bn = inference_graph == 'folded'
+            sample_X, sample_Y = next(iter(self.whole_X_set)), next(iter(self.whole_Y_set))
+            self.generator_G, diff_G = md.fold_generator(self.generator_G, self.options, fold_bn, sample_X)
+            self.generator_F, diff_F = md.fold_generator(self.generator_F, self.options, fold_bn, sample_Y)
+            print("inference graph : {}, max abs diff G : {:.6f}, F : {:.6f}".format(inference_graph,
+                                                                                      diff_G, diff_F))
+
         ## mk save dir (image & numpy file)    
         npy_save_dir = os.path.join(args.test_npy_save_dir, self.taskID)
 
         if not os.path.exists(npy_save_dir):
             os.makedirs(npy_save_dir)
 
-        ## test
-        for idx, test_X in enumerate(self.whole_X_set):
-            mk_G_X = self.generator_G(test_X)
-            save_file_nm_g = 'Gen_from_' + self.test_image_loader.LDCT_image_name[idx]
-
-            np.save(os.path.join(npy_save_dir, save_file_nm_g), mk_G_X)  # save as shape [1, whole_size, whole_size, 1]
-
-        for idx, test_Y in enumerate(self.whole_Y_set):
-            mk_F_Y = self.generator_F(test_Y)
-            save_file_nm_f = 'Gen_from_' + self.test_image_loader.NDCT_image_name[idx]
+        def generate(generator, x):
+            if args.tile_size > 0:
+                # overlapping tiles of tile_size through the folded generator, blended back to the whole image
+                return iu.tiled_inference(generator, x, args.tile_size, args.tile_overlap, args.tile_batch)
+            return generator(x)
+
+        # one .npy file per slice, shape [1, whole_size, whole_size, 1]
+        def save_slices(generator, whole_set, image_name):
+            idx = 0
+            for test_batch in whole_set:
+                for mk_img in np.asarray(generate(generator, test_batch)):
+                    np.save(os.path.join(npy_save_dir, 'Gen_from_' + image_name[idx]), mk_img[np.newaxis])
+                    idx += 1
+
+        # one memory-mapped .npy volume + json per patient, written in a background thread
+        def save_volumes(generator, whole_set, patent_no_list, patient_files, domain_name):
+            writer = ut.VolumeWriter(npy_save_dir, patent_no_list, patient_files, domain_name,
+                                     args.img_vmin, args.img_vmax)
+            writer.start()
+            for test_batch in whole_set:
+                writer.put(generate(generator, test_batch))
+            writer.close()
+
+        # one dicom per slice with the header of its source file, written by a pool of worker processes
+        def save_dicoms(generator, whole_set, patent_no_list, patient_files, domain_name):
+            writer = ut.DicomSeriesWriter(npy_save_dir, patent_no_list, patient_files, domain_name,
+                                          args.img_vmin, args.img_vmax, workers=args.write_workers)
+            writer.start()
+            for test_batch in whole_set:
+                writer.put(generate(generator, test_batch))
+            writer.close()
 
-            np.save(os.path.join(npy_save_dir, save_file_nm_f), mk_F_Y)  # save as shape [1, whole_size, whole_size, 1]
+        ## test
+        if args.test_output == 'dicom':
+            if args.extension != 'dcm':
+                raise ValueError('--test_output dicom needs dicom source files (--extension dcm)')
+            save_dicoms(self.generator_G, self.whole_X_set, args.test_patient_no_A,
+                        self.test_image_loader.LDCT_patient_files, 'A')
+            save_dicoms(self.generator_F, self.whole_Y_set, args.test_patient_no_B,
+                        self.test_image_loader.NDCT_patient_files, 'B')
+        elif args.test_output == 'volume':
+            save_volumes(self.generator_G, self.whole_X_set, args.test_patient_no_A,
+                         self.test_image_loader.LDCT_patient_files, 'A')
+            save_volumes(self.generator_F, self.whole_Y_set, args.test_patient_no_B,
+                         self.test_image_loader.NDCT_patient_files, 'B')
+        else:
+            save_slices(self.generator_G, self.whole_X_set, self.test_image_loader.LDCT_image_name)
+            save_slices(self.generator_F, self.whole_Y_set, self.test_image_loader.NDCT_image_name)
@@ -4,10 +4,17 @@ Created on Sat Oct 27 19:52:02 2018
 
 @author: yeohyeongyu
 """
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 
 
+# network dtype : float32, mixed_bfloat16 or mixed_float16 (keras mixed precision policy of the layers built after)
+# variables stay float32, the model outputs are float32
+def set_precision(precision='float32'):
+    tf.keras.mixed_precision.set_global_policy(precision)
+
+
 def discriminator(image_shape, options, name='discriminator'):
     def first_layer(input_, out_channels, ks=3, s=1):
         return lrelu(conv2d(input_, out_channels, ks=ks, s=s))
@@ -16,7 +23,7 @@ def discriminator(image_shape, options, name='discriminator'):
         return lrelu(batchnorm(conv2d(input_, out_channels, ks=ks, s=s)))
 
     def last_layer(input_, out_channels, ks=4, s=1):
-        return layers.Dense(units=out_channels)(conv2d(input_, out_channels, ks=ks, s=s))
+        return layers.Dense(units=out_channels, dtype='float32')(conv2d(input_, out_channels, ks=ks, s=s))
 
     inputs = tf.keras.Input(shape=image_shape)
     l1 = first_layer(inputs, options.df_dim, ks=4, s=2)
@@ -29,9 +36,18 @@ def discriminator(image_shape, options, name='discriminator'):
     return model
 
 
-def generator(image_shape, options, name="generator"):
+def generator(image_shape, options, name="generator", same_conv=False, use_batchnorm=True):
+    # same_conv=True : 'same' convolution instead of tf.pad + 'valid' convolution (identical for ks=3, s=1)
+    # use_batchnorm=False : no batch norm layer (folded into the convolution, see fold_generator)
+    def conv(input_, out_channels, ks=3, s=1):
+        if same_conv:
+            return conv2d_same(input_, out_channels, ks=ks, s=s)
+        return conv2d(input_, out_channels, ks=ks, s=s)
+
     def conv_layer(input_, out_channels, ks=3, s=1):
-        return layers.ReLU()(batchnorm(conv2d(input_, out_channels, ks=ks, s=s)))
+        if use_batchnorm:
+            return layers.ReLU()(batchnorm(conv(input_, out_channels, ks=ks, s=s)))
+        return layers.ReLU()(conv(input_, out_channels, ks=ks, s=s))
 
     def gen_module(input_, out_channels, ks=3, s=1):
         ml1 = conv_layer(input_, out_channels, ks, s)
@@ -54,12 +70,75 @@ def generator(image_shape, options, name="generator"):
                                         module2, module3, module4, module5, module6], axis=3)
     concat_conv_l1 = conv_layer(concate_layer, options.gf_dim, ks=3, s=1)
     last_conv_layer = conv_layer(concat_conv_l1, options.glf_dim, ks=3, s=1)
-    output = layers.Add(name='output')([conv2d(last_conv_layer, options.img_channel, ks=3, s=1), inputs])
+    # residual output in float32 (the input image is not rounded to the compute dtype)
+    output = layers.Add(name='output', dtype='float32')([conv(last_conv_layer, options.img_channel, ks=3, s=1),
+                                                         inputs])
 
     model = tf.keras.Model(inputs=inputs, outputs=output, name=name)
     return model
 
 
+def recompute_generator(generator_model):
+    """
+    memory saving call of a trained generator : the activations inside each gen_module are not kept for backprop,
+    they are recomputed from the module input during the backward pass (tf.recompute_grad).
+    the segments share the layers of generator_model, so the variables and the checkpoint are unchanged.
+    note : batch norm moving statistics are updated again by the recomputation (used by fold_generator only)
+    returns call(x) -> generator_model(x)
+    """
+    concat = [layer for layer in generator_model.layers if isinstance(layer, layers.Concatenate)][0]
+    features = concat.input  # [l1, module1, ..., module6]
+    stem = tf.keras.Model(generator_model.input, features[0])
+    modules = [tf.recompute_grad(tf.keras.Model(features[k], features[k + 1])) for k in range(len(features) - 1)]
+    head = tf.keras.Model([generator_model.input] + list(features), generator_model.output)
+
+    def call(x):
+        features = [stem(x)]
+        for module in modules:
+            features.append(module(features[-1]))
+        return head([x] + features)
+
+    return call
+
+
+def fold_generator(generator_model, options, fold_bn=True, sample=None, image_shape=None):
+    """
+    inference graph of a trained generator.
+    tf.pad + 'valid' conv are merged into 'same' convs, and with fold_bn=True every batch norm is folded into
+    the preceding conv kernel / bias with its moving statistics.
+    fold_bn=False keeps the batch norm layers (batch statistics, same output as the trained generator).
+    if sample is given, returns (model, max absolute output difference against generator_model on sample)
+    image_shape : input shape of the new model (default : same as generator_model)
+    """
+    if image_shape is None:
+        image_shape = tuple(generator_model.input_shape[1:])
+    model = generator(image_shape, options, name=generator_model.name + '_inference',
+                      same_conv=True, use_batchnorm=not fold_bn)
+
+    def layers_of(m, layer_type):
+        return [layer for layer in m.layers if isinstance(layer, layer_type)]
+
+    src_convs = layers_of(generator_model, layers.Conv2D)
+    src_bns = {id(bn.input): bn for bn in layers_of(generator_model, layers.BatchNormalization)}
+    for src_conv, dst_conv in zip(src_convs, layers_of(model, layers.Conv2D)):
+        kernel, bias = src_conv.get_weights()
+        bn = src_bns.get(id(src_conv.output))
+        if fold_bn and bn is not None:
+            gamma, beta, moving_mean, moving_var = bn.get_weights()
+            scale = gamma / np.sqrt(moving_var + bn.epsilon)
+            kernel, bias = kernel * scale, (bias - moving_mean) * scale + beta
+        dst_conv.set_weights([kernel, bias])
+    if not fold_bn:
+        for src_bn, dst_bn in zip(layers_of(generator_model, layers.BatchNormalization),
+                                  layers_of(model, layers.BatchNormalization)):
+            dst_bn.set_weights(src_bn.get_weights())
+
+    if sample is None:
+        return model
+    max_diff = float(tf.math.reduce_max(tf.math.abs(generator_model(sample) - model(sample))))
+    return model, max_diff
+
+
 # network components
 def lrelu(x, leak=0.2):
     return layers.LeakyReLU(alpha=leak)(x)
@@ -76,14 +155,22 @@ def conv2d(batch_input, out_channels, ks=4, s=2):
                          kernel_initializer=tf.random_normal_initializer(0, 0.02))(padded_input)
 
 
-#### loss
+def conv2d_same(batch_input, out_channels, ks=4, s=2):
+    return layers.Conv2D(out_channels, kernel_size=ks, strides=s, padding="same",
+                         kernel_initializer=tf.random_normal_initializer(0, 0.02))(batch_input)
+
+
+#### loss (float32 with any precision policy)
 def least_square(A, B):
+    A, B = tf.cast(A, tf.float32), tf.cast(B, tf.float32)
     return tf.math.reduce_mean((A - B) ** 2)
 
 
 def cycle_loss(A, F_GA, B, G_FB, lambda_):
+    A, F_GA, B, G_FB = [tf.cast(x, tf.float32) for x in (A, F_GA, B, G_FB)]
     return lambda_ * (tf.math.reduce_mean(tf.math.abs(A - F_GA)) + tf.math.reduce_mean(tf.math.abs(B - G_FB)))
 
 
 def identity_loss(A, G_B, B, F_A, gamma):
+    A, G_B, B, F_A = [tf.cast(x, tf.float32) for x in (A, G_B, B, F_A)]
     return gamma * (tf.math.reduce_mean(tf.math.abs(G_B - B)) + tf.math.reduce_mean(tf.math.abs(F_A - A)))
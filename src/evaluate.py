@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    evaluate.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+image quality of full test outputs against the paired reference slices (test lists, paired by patient and slice order)
+    python main.py --phase eval --eval_source generator ...  : generators of the latest checkpoint of taskID
+    python main.py --phase eval --eval_source saved ...      : outputs of --phase test (slice, volume or dicom)
+AtoB : G(A patient) vs B patient, BtoA : F(B patient) vs A patient, the input_* metrics are the input vs the reference.
+per slice metrics (HU) : PSNR (peak --psnr_range), SSIM (gaussian 11 x 11, sigma 1.5, same as tf.image.ssim),
+RMSE, noise std in each ROI (--eval_rois). the metrics are numpy only and run in --eval_workers processes.
+results : <test_npy_save_dir>/<taskID>/eval_slices.csv, eval_patients.csv, eval_summary.json
+"""
+
+import os
+import csv
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import tensorflow as tf
+import cycle_identity_module as md
+import inout_util as ut
+import infer
+
+DIRECTIONS = {'AtoB': ('X2Y', 'A'), 'BtoA': ('Y2X', 'B')}
+
+
+def parse_rois(rois, image_size):
+    """'y,x,h,w;y,x,h,w' -> [(y, x, h, w)], default : one image_size / 8 square in the image center"""
+    if not rois:
+        size = max(image_size // 8, 1)
+        return [((image_size - size) // 2, (image_size - size) // 2, size, size)]
+    return [tuple(int(v) for v in roi.split(',')) for roi in rois.split(';')]
+
+
+def gaussian_filter(x, size=11, sigma=1.5):
+    # separable 'valid' gaussian filter over the H, W axes of [N, H, W]
+    g = np.exp(-(np.arange(size, dtype=np.float32) - (size - 1) / 2.0) ** 2 / (2 * sigma ** 2))
+    g /= g.sum()
+    x = np.lib.stride_tricks.sliding_window_view(x, size, axis=1) @ g
+    return np.lib.stride_tricks.sliding_window_view(x, size, axis=2) @ g
+
+
+def ssim(ref, out, data_range, k1=0.01, k2=0.03):
+    # [N, H, W] -> [N]
+    ref, out = ref / data_range, out / data_range
+    c1, c2 = k1 ** 2, k2 ** 2
+    mu_r, mu_o = gaussian_filter(ref), gaussian_filter(out)
+    var_r = gaussian_filter(ref * ref) - mu_r ** 2
+    var_o = gaussian_filter(out * out) - mu_o ** 2
+    cov = gaussian_filter(ref * out) - mu_r * mu_o
+    luminance = (2 * mu_r * mu_o + c1) / (mu_r ** 2 + mu_o ** 2 + c1)
+    cs = (2 * cov + c2) / (var_r + var_o + c2)
+    return np.mean(luminance * cs, axis=(1, 2))
+
+
+def slice_metrics(ref, out, data_range, rois):
+    """HU slices [N, H, W] -> {metric: [N]}"""
+    rmse = np.sqrt(np.mean((out - ref) ** 2, axis=(1, 2)))
+    metrics = {'psnr': 20 * np.log10(data_range / np.maximum(rmse, 1e-8)), 'ssim': ssim(ref, out, data_range),
+               'rmse_hu': rmse}
+    for k, (y, x, h, w) in enumerate(rois):
+        metrics['noise_roi{}'.format(k)] = np.std(out[:, y:y + h, x:x + w], axis=(1, 2))
+    return metrics
+
+
+def read_hu_slices(files):
+    return np.stack([ut.read_hu(fn)[..., 0] for fn in files]).astype(np.float32)
+
+
+def load_saved_output(save_dir, patent_no, domain, files, image_min, image_max):
+    """HU outputs of --phase test for one patient : volume, dicom series or one .npy per slice"""
+    volume_path = os.path.join(save_dir, 'Gen_from_{}_{}.npy'.format(patent_no, domain))
+    series_dir = os.path.join(save_dir, '{}_{}'.format(patent_no, domain))
+    if os.path.exists(volume_path):
+        out = np.load(volume_path, mmap_mode='r')[..., 0]
+    elif os.path.isdir(series_dir):
+        return read_hu_slices([os.path.join(series_dir, os.path.basename(fn)) for fn in files])
+    else:
+        names = ut.get_image_name([patent_no], [files], domain)
+        out = np.stack([np.load(os.path.join(save_dir, 'Gen_from_' + name + '.npy'))[0, ..., 0] for name in names])
+    return np.asarray(out, np.float32) * (image_max - image_min) + image_min
+
+
+def score_patient(task):
+    """
+    one (direction, patient) in a worker process (numpy / pydicom only).
+    reference / input : HU slices, or dicom files decoded here. output : HU slices, or a saved output spec
+    returns per slice rows
+    """
+    def hu(value):
+        return read_hu_slices(value) if isinstance(value, list) else value
+
+    ref, inp = hu(task['ref']), hu(task['input'])
+    out = task['output']
+    if isinstance(out, dict):
+        out = load_saved_output(**out)
+    if not (len(ref) == len(inp) == len(out)):
+        raise ValueError('{} : {} reference, {} input, {} output slices'.format(
+            task['patent_no'], len(ref), len(inp), len(out)))
+
+    metrics = slice_metrics(ref, out, task['data_range'], task['rois'])
+    metrics.update({'input_' + key: value
+                    for key, value in slice_metrics(ref, inp, task['data_range'], task['rois']).items()})
+    for k, (y, x, h, w) in enumerate(task['rois']):
+        metrics['ref_noise_roi{}'.format(k)] = np.std(ref[:, y:y + h, x:x + w], axis=(1, 2))
+
+    return [dict({'direction': task['direction'], 'patent_no': task['patent_no'], 'slice': i},
+                 **{key: float(value[i]) for key, value in metrics.items()}) for i in range(len(ref))]
+
+
+def patient_tasks(args, loader):
+    """
+    (direction, input patient, reference patient, input files, reference files) of the paired test lists
+    """
+    pairs = list(zip(args.test_patient_no_A, args.test_patient_no_B))
+    for direction, (_, domain) in DIRECTIONS.items():
+        for patent_A, patent_B in pairs:
+            files_A = loader.get_files(patent_A)
+            files_B = loader.get_files(patent_B)
+            if domain == 'A':
+                yield direction, domain, patent_A, files_A, files_B
+            else:
+                yield direction, domain, patent_B, files_B, files_A
+
+
+def evaluate(args):
+    loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size, image_max=args.img_vmax,
+                              image_min=args.img_vmin, extension=args.extension, phase='test',
+                              manifest=args.manifest)
+    save_dir = os.path.join(args.test_npy_save_dir, args.taskID)
+    data_range = args.psnr_range if args.psnr_range > 0 else float(args.img_vmax - args.img_vmin)
+    rois = parse_rois(args.eval_rois, args.whole_size)
+
+    # metrics run in forked workers (numpy / pydicom only) while the generator runs on the next patient,
+    # forked now, before tensorflow is used
+    pool = ProcessPoolExecutor(max_workers=max(args.eval_workers, 1), mp_context=multiprocessing.get_context('fork'))
+    pool.submit(os.getpid).result()
+
+    generators, batch_size = None, args.eval_batch_size
+    if args.eval_source == 'generator':
+        generators, options = infer.load_generators(args)
+        if generators is None:
+            pool.shutdown()
+            return
+        for direction in generators:
+            if args.inference_graph != 'keras':
+                generators[direction] = md.fold_generator(generators[direction], options,
+                                                          args.inference_graph == 'folded')
+        generate = {direction: tf.function(lambda x, g=g: g(x, training=False))
+                    for direction, g in generators.items()}
+        # same slice outputs as --phase test : only the folded graph can batch slices
+        if args.inference_graph != 'folded' and batch_size > 1:
+            print(" [!] {} inference graph normalizes with batch statistics, eval_batch_size {} -> 1 "
+                  "(only --inference_graph folded can batch slices)".format(args.inference_graph, batch_size))
+            batch_size = 1
+    elif not os.path.isdir(save_dir):
+        pool.shutdown()
+        raise ValueError('no saved test outputs in {} (--phase test first, or --eval_source generator)'.format(save_dir))
+
+    t = time.time()
+    rows, futures = [], []
+    with pool:
+        for direction, domain, patent_no, input_files, ref_files in patient_tasks(args, loader):
+            task = {'direction': direction, 'patent_no': patent_no, 'data_range': data_range, 'rois': rois,
+                    'ref': ref_files, 'input': input_files}
+            if args.extension != 'dcm':
+                task['ref'] = loader.read_slices(ref_files)[..., 0] * (args.img_vmax - args.img_vmin) + args.img_vmin
+                task['input'] = loader.read_slices(input_files)[..., 0] * (args.img_vmax - args.img_vmin) + args.img_vmin
+            if generators is not None:
+                images = loader.read_slices(input_files)
+                out = np.concatenate([generate[DIRECTIONS[direction][0]](images[b:b + batch_size]).numpy()
+                                      for b in range(0, len(images), batch_size)])
+                task['output'] = out[..., 0] * (args.img_vmax - args.img_vmin) + args.img_vmin
+            else:
+                task['output'] = {'save_dir': save_dir, 'patent_no': patent_no, 'domain': domain,
+                                  'files': input_files, 'image_min': args.img_vmin, 'image_max': args.img_vmax}
+            futures.append(pool.submit(score_patient, task))
+        for future in futures:
+            rows.extend(future.result())
+    elapsed = time.time() - t
+
+    write_results(save_dir, rows, elapsed)
+
+
+def write_results(save_dir, rows, elapsed):
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    metric_keys = [key for key in rows[0] if key not in ('direction', 'patent_no', 'slice')]
+
+    # per patient : mean over the slices, per cohort (direction) : mean / std over all slices
+    patients, summary = [], {'n_slices': len(rows), 'seconds': elapsed, 'slices_per_sec': len(rows) / elapsed,
+                             'directions': {}}
+    for direction in DIRECTIONS:
+        d_rows = [row for row in rows if row['direction'] == direction]
+        if not d_rows:
+            continue
+        for patent_no in sorted({row['patent_no'] for row in d_rows}):
+            p_rows = [row for row in d_rows if row['patent_no'] == patent_no]
+            patients.append(dict({'direction': direction, 'patent_no': patent_no, 'n_slices': len(p_rows)},
+                                 **{key: float(np.mean([row[key] for row in p_rows])) for key in metric_keys}))
+        summary['directions'][direction] = {
+            key: {'mean': float(np.mean([row[key] for row in d_rows])),
+                  'std': float(np.std([row[key] for row in d_rows]))} for key in metric_keys}
+        summary['directions'][direction]['n_slices'] = len(d_rows)
+    summary['patients'] = patients
+
+    for name, table in (('eval_slices.csv', rows), ('eval_patients.csv', patients)):
+        with open(os.path.join(save_dir, name), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(table[0]))
+            writer.writeheader()
+            writer.writerows(table)
+    with open(os.path.join(save_dir, 'eval_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for direction, metrics in summary['directions'].items():
+        print('{} : psnr {:.3f} (input {:.3f}), ssim {:.4f} (input {:.4f}), rmse {:.2f} HU (input {:.2f})'.format(
+            direction, metrics['psnr']['mean'], metrics['input_psnr']['mean'], metrics['ssim']['mean'],
+            metrics['input_ssim']['mean'], metrics['rmse_hu']['mean'], metrics['input_rmse_hu']['mean']))
+    print('{} slices, {:.1f} slices/sec -> {}'.format(len(rows), len(rows) / elapsed, save_dir))
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    infer.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+generator-only SavedModel export and a lightweight inference API / CLI.
+the exported model does not need the discriminators, the optimizers or the data loader.
+
+export (from a training checkpoint) :
+    python main.py --phase export --taskID <taskID> --checkpoint_dir ... --export_dir ... (+ data/list args)
+inference :
+    python infer.py --model_dir <export_dir>/<taskID>/generatorX2Y --input_dir <dcm dir> [<dcm dir> ...]
+                    --output_dir <save dir>
+"""
+
+import os
+import argparse
+from glob import glob
+import numpy as np
+import tensorflow as tf
+import inout_util as ut
+
+GENERATOR_NAMES = {'X2Y': 'generatorX2Y', 'Y2X': 'generatorY2X'}
+
+
+class GeneratorModule(tf.Module):
+    """
+    serving wrapper of one generator, batch and image size polymorphic
+    serving_default : normalized images [N, H, W, C] float32 -> {'output': normalized images}
+    denoise_hu      : HU images [N, H, W, C] int16 -> {'output': HU images float32}
+    inference_graph : keras / fused (batch statistics, an output depends on its batch) or folded (per slice)
+    """
+    def __init__(self, generator, img_channel, image_min, image_max, inference_graph='keras'):
+        super(GeneratorModule, self).__init__()
+        self.generator = generator
+        self.image_min = tf.Variable(float(image_min), trainable=False)
+        self.image_max = tf.Variable(float(image_max), trainable=False)
+        self.inference_graph = tf.Variable(inference_graph, trainable=False)
+        self.serve = tf.function(self._serve,
+                                 input_signature=[tf.TensorSpec([None, None, None, img_channel], tf.float32)])
+        self.denoise_hu = tf.function(self._denoise_hu,
+                                      input_signature=[tf.TensorSpec([None, None, None, img_channel], tf.int16)])
+
+    def _serve(self, images):
+        return {'output': self.generator(images, training=False)}
+
+    def _denoise_hu(self, images):
+        images = (tf.cast(images, tf.float32) - self.image_min) / (self.image_max - self.image_min)
+        output = self.generator(images, training=False)
+        return {'output': output * (self.image_max - self.image_min) + self.image_min}
+
+
+def load_generators(args):
+    """
+    build the two generators only and restore them from the latest training checkpoint of args.taskID
+    returns ({'X2Y': generator, 'Y2X': generator}, network options), or (None, options) if there is no checkpoint
+    """
+    import cycle_identity_module as md
+    from collections import namedtuple
+
+    OPTIONS = namedtuple('OPTIONS', 'gf_dim glf_dim df_dim img_channel is_training')
+    options = OPTIONS._make((args.ngf, args.nglf, args.ndf, args.img_channel, False))
+    generator_shape = (None, None, args.img_channel)
+    generators = {'X2Y': md.generator(generator_shape, options, name=GENERATOR_NAMES['X2Y']),
+                  'Y2X': md.generator(generator_shape, options, name=GENERATOR_NAMES['Y2X'])}
+
+    checkpoint_dir = os.path.join(args.checkpoint_dir, args.taskID)
+    ckpt_path = tf.train.latest_checkpoint(checkpoint_dir)
+    if ckpt_path is None:
+        print(" [!] Load failed... no checkpoint in {}".format(checkpoint_dir))
+        return None, options
+    tf.train.Checkpoint(generator_G=generators['X2Y'], generator_F=generators['Y2X']).restore(ckpt_path).expect_partial()
+    print(" [*] Load SUCCESS : {}".format(ckpt_path))
+    return generators, options
+
+
+def export_generator(args):
+    import cycle_identity_module as md
+
+    generators, options = load_generators(args)
+    if generators is None:
+        return
+
+    for direction in args.export_direction.split(','):
+        generator = generators[direction]
+        if args.inference_graph != 'keras':
+            # fused pad + conv (, folded batch norm)
+            sample = tf.random.uniform([1, args.patch_size, args.patch_size, args.img_channel])
+            generator, diff = md.fold_generator(generator, options, args.inference_graph == 'folded', sample)
+            print("inference graph : {}, max abs diff {} : {:.6f}".format(args.inference_graph, direction, diff))
+        module = GeneratorModule(generator, args.img_channel, args.img_vmin, args.img_vmax, args.inference_graph)
+        save_path = os.path.join(args.export_dir, args.taskID, GENERATOR_NAMES[direction])
+        tf.saved_model.save(module, save_path,
+                            signatures={'serving_default': module.serve, 'denoise_hu': module.denoise_hu})
+        print("Export generator : " + save_path)
+
+
+class GeneratorInference(object):
+    """
+    python API over an exported generator
+        model = GeneratorInference('<export_dir>/<taskID>/generatorX2Y')
+        for path, hu in model.run_files(sorted(glob('<dcm dir>/*.dcm'))):
+            ...
+    only a folded export gives the same output for a slice whatever it is batched with, so the slices of
+    other exports (keras, fused or exported before the graph was recorded) are run one at a time
+    """
+    def __init__(self, model_dir, batch_size=8):
+        self.model = tf.saved_model.load(model_dir)
+        self.image_min = float(self.model.image_min.numpy())
+        self.image_max = float(self.model.image_max.numpy())
+        self.inference_graph = (self.model.inference_graph.numpy().decode('utf-8')
+                                if hasattr(self.model, 'inference_graph') else 'unrecorded')
+        self.batch_independent = self.inference_graph == 'folded'
+        if batch_size > 1 and not self.batch_independent:
+            print(' [!] {} : {} inference graph, batch_size {} -> 1 '
+                  '(only a --inference_graph folded export can batch slices)'.format(
+                      model_dir, self.inference_graph, batch_size))
+            batch_size = 1
+        self.batch_size = batch_size
+
+    # normalized images [N, H, W, C] -> normalized images
+    def __call__(self, images):
+        return self.model.serve(tf.convert_to_tensor(images, tf.float32))['output'].numpy()
+
+    # HU images [N, H, W, C] -> HU images
+    def denoise_hu(self, images):
+        return self.model.denoise_hu(tf.convert_to_tensor(images, tf.int16))['output'].numpy()
+
+    def normalize(self, hu):
+        return (np.asarray(hu, np.float32) - self.image_min) / (self.image_max - self.image_min)
+
+    # stream dicom files : yields (path, normalized output [H, W, C]), batch_size files per generator call
+    def run_files(self, paths):
+        for b in range(0, len(paths), self.batch_size):
+            batch_paths = paths[b:b + self.batch_size]
+            output = self(self.normalize(np.stack([ut.read_hu(path) for path in batch_paths])))
+            for path, img in zip(batch_paths, output):
+                yield path, img
+
+
+def main():
+    parser = argparse.ArgumentParser(description='denoise dicom series with an exported generator')
+    parser.add_argument('--model_dir', dest='model_dir', required=True, help='exported generator (SavedModel) dir')
+    parser.add_argument('--input_dir', dest='input_dir', nargs='+', required=True,
+                        help='dicom dirs, one volume is written per dir')
+    parser.add_argument('--output_dir', dest='output_dir', required=True, help='output volume save dir')
+    parser.add_argument('--extension', dest='extension', default='dcm', help='file extension')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=8,
+                        help='# of slices per generator call (folded export only, else 1)')
+    args = parser.parse_args()
+
+    model = GeneratorInference(args.model_dir, batch_size=args.batch_size)
+    domain_name = os.path.basename(os.path.normpath(args.model_dir))
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    for input_dir in args.input_dir:
+        files = sorted(glob(os.path.join(input_dir, '*.' + args.extension)))
+        patent_no = os.path.basename(os.path.normpath(input_dir))
+        writer = ut.VolumeWriter(args.output_dir, [patent_no], [files], domain_name, model.image_min, model.image_max)
+        writer.start()
+        for _, img in model.run_files(files):
+            writer.put(img[np.newaxis])
+        writer.close()
+        print('{} : {} slices -> {}'.format(patent_no, len(files), writer.volume_path(patent_no)))
+
+
+if __name__ == '__main__':
+    main()
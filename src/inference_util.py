@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    inference_util.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+"""
+
+import numpy as np
+
+
+# tile start positions along one axis, the last tile is aligned to the image border
+def tile_positions(size, tile_size, stride):
+    if size <= tile_size:
+        return [0]
+    positions = list(range(0, size - tile_size, stride))
+    positions.append(size - tile_size)
+    return positions
+
+
+# blending weight of one tile : linear ramp over the overlap, 1 in the middle
+def blend_window(tile_h, tile_w, overlap):
+    def ramp(length):
+        r = np.ones(length, dtype=np.float32)
+        o = min(overlap, length // 2)
+        if o > 0:
+            edge = (np.arange(o, dtype=np.float32) + 0.5) / o
+            r[:o] = edge
+            r[-o:] = edge[::-1]
+        return r
+
+    return np.outer(ramp(tile_h), ramp(tile_w))[..., np.newaxis]
+
+
+def tiled_inference(model, images, tile_size, overlap=32, tile_batch=16):
+    """
+    run a fully convolutional generator over overlapping tiles and blend the tiles back.
+    peak activation memory is bounded by tile_batch * tile_size^2, not by the image size,
+    so any whole_size (512, 1024, ...) can be processed with the same model.
+    model : generator without batch statistics (batch norm folded, cycle_identity_module.fold_generator),
+            with batch statistics every tile would depend on the tiles it is batched with
+    the output near a tile border is computed with zero padding instead of the neighboring pixels,
+    so the overlap should cover the receptive field of the generator to match the whole image output
+    images : [N, H, W, C] -> [N, H, W, C]
+    """
+    images = np.asarray(images, dtype=np.float32)
+    n, h, w, _ = images.shape
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    overlap = min(overlap, tile_h - 1, tile_w - 1)
+
+    ys = tile_positions(h, tile_h, tile_h - overlap)
+    xs = tile_positions(w, tile_w, tile_w - overlap)
+    window = blend_window(tile_h, tile_w, overlap)
+
+    out, weight = None, np.zeros((n, h, w, 1), dtype=np.float32)
+    coords = [(i, y, x) for i in range(n) for y in ys for x in xs]
+    for b in range(0, len(coords), tile_batch):
+        batch = coords[b:b + tile_batch]
+        tiles = np.stack([images[i, y:y + tile_h, x:x + tile_w] for i, y, x in batch])
+        pred = np.asarray(model(tiles, training=False))
+        if out is None:
+            out = np.zeros((n, h, w, pred.shape[-1]), dtype=np.float32)
+        for (i, y, x), p in zip(batch, pred):
+            out[i, y:y + tile_h, x:x + tile_w] += p * window
+            weight[i, y:y + tile_h, x:x + tile_w] += window
+
+    return out / weight
@@ -10,10 +10,17 @@ All rights reserved.
 """
 
 import os
+import json
+import queue
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 import tensorflow as tf
 import numpy as np
 import pydicom
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
 from datetime import datetime
 
 
@@ -91,14 +98,52 @@ def get_pixel_hu(dcm_file):
         image = slope * image.astype(np.float32)
         image = image.astype(np.int16)
     image += np.int16(intercept)
-    image = tf.expand_dims(image, axis=-1)
+    image = np.expand_dims(image, axis=-1)
     return image
 
 
+# HU image -> stored pixel values of dcm_file (inverse of get_pixel_hu : slope / intercept, pixel representation)
+def hu_to_pixel(hu, dcm_file):
+    stored = (np.asarray(hu, np.float32) - float(dcm_file.RescaleIntercept)) / float(dcm_file.RescaleSlope)
+    bits = int(dcm_file.BitsStored)
+    if int(dcm_file.PixelRepresentation) == 1:
+        low, high, dtype = -2 ** (bits - 1), 2 ** (bits - 1) - 1, np.int16
+    else:
+        low, high, dtype = 0, 2 ** bits - 1, np.uint16
+    return np.clip(np.round(stored), low, high).astype(dtype)
+
+
+def write_dicom_slice(src_path, dst_path, img, image_min, image_max, series_uid, series_description):
+    """
+    normalized generator output [H, W, C] -> dicom with the header of the source slice (numpy / pydicom only,
+    runs in the writer worker processes). new SOP instance uid, series_uid of the output series
+    """
+    ds = pydicom.dcmread(src_path)
+    hu = np.asarray(img, np.float32)[..., 0] * (image_max - image_min) + image_min
+    ds.PixelData = hu_to_pixel(hu, ds).tobytes()
+    ds.Rows, ds.Columns = hu.shape
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesDescription = series_description
+    ds.ImageType = ['DERIVED', 'SECONDARY'] + list(ds.get('ImageType', ['', ''])[2:])
+    for keyword in ('SmallestImagePixelValue', 'LargestImagePixelValue'):
+        if keyword in ds:
+            delattr(ds, keyword)
+    ds.save_as(dst_path)
+    return dst_path
+
+
+# dicom path -> HU image (numpy only, safe to run in decode worker processes)
+def read_hu(path):
+    return get_pixel_hu(pydicom.dcmread(path))
+
+
 def dcm_read(path):
     path = path.numpy().decode('utf-8')
-    dcm_file = pydicom.dcmread(path)
-    img = get_pixel_hu(dcm_file)
+    img = read_hu(path)
     return img
 
 
@@ -107,20 +152,131 @@ def read_function_dcm(fn):
     return out
 
 
+# HU slice cache : one int16 volume (N, H, W) per patient + json index
+def hu_cache_path(cache_dir, patent_no):
+    return os.path.join(cache_dir, patent_no + '.npy'), os.path.join(cache_dir, patent_no + '.json')
+
+
+# the source files are stat'ed (also with a manifest), a rewritten file invalidates the cache
+def is_valid_hu_cache(cache_dir, patent_no, files):
+    volume_path, index_path = hu_cache_path(cache_dir, patent_no)
+    if not (os.path.exists(volume_path) and os.path.exists(index_path)):
+        return False
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    return (index['files'] == [os.path.basename(fn) for fn in files] and
+            index['mtimes'] == [os.path.getmtime(fn) for fn in files])
+
+
+def build_hu_cache(data_path, patent_no, cache_dir, extension='dcm', pool=None, files=None):
+    """
+    decode every dicom of one patient once and store the HU slices as a memory-mappable .npy volume.
+    the volume is rebuilt only when the file list or the mtime of a source file has changed.
+    slices are stored in the order of files (default : file name order), the order of the DCMDataLoader datasets
+    """
+    if files is None:
+        files = sorted(glob(os.path.join(data_path, patent_no, '*.' + extension)))
+    if not files:
+        raise ValueError('no slices : {} ({})'.format(patent_no, os.path.join(data_path, patent_no)))
+    if is_valid_hu_cache(cache_dir, patent_no, files):
+        return False
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    volume_path, index_path = hu_cache_path(cache_dir, patent_no)
+    tmp_path = volume_path + '.tmp'
+
+    volume = None
+    images = pool.map(read_hu, files, chunksize=8) if pool else map(read_hu, files)
+    for idx, img in enumerate(images):
+        img = img[..., 0]
+        if volume is None:
+            volume = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int16, shape=(len(files),) + img.shape)
+        volume[idx] = img
+    volume.flush()
+    shape = list(volume.shape)
+    del volume
+    os.replace(tmp_path, volume_path)
+
+    index = {'patent_no': patent_no, 'shape': shape,
+             'files': [os.path.basename(fn) for fn in files],
+             'mtimes': [os.path.getmtime(fn) for fn in files]}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    return True
+
+
+# dicom header of one slice (no pixel data) : z-position, rescale parameters, shape
+def read_slice_header(path):
+    dcm = pydicom.dcmread(path, stop_before_pixels=True)
+    position = getattr(dcm, 'ImagePositionPatient', None)
+    z = float(position[2]) if position is not None else float(getattr(dcm, 'SliceLocation', 0.0))
+    return {'z': z, 'slope': float(getattr(dcm, 'RescaleSlope', 1.0)),
+            'intercept': float(getattr(dcm, 'RescaleIntercept', 0.0)),
+            'shape': [int(dcm.Rows), int(dcm.Columns)]}
+
+
+def load_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {'patients': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def build_manifest(data_path, patent_no_list, manifest_path, extension='dcm', pool=None):
+    """
+    patient manifest (json) : per patient slice files sorted by z-position (ImagePositionPatient,
+    as load_scan), z-positions, rescale slope / intercept, image shape and source file mtimes.
+    the loaders read the file lists from the manifest instead of listing every patient dir.
+    patients already in the manifest are kept while their files and mtimes are unchanged, changed patients
+    (added, removed or rewritten files) are read again and new ones are added. returns the manifest
+    """
+    manifest = load_manifest(manifest_path)
+    manifest.update({'data_path': data_path, 'extension': extension})
+    for patent_no in patent_no_list:
+        files = sorted(glob(os.path.join(data_path, patent_no, '*.' + extension)))
+        entry = manifest['patients'].get(patent_no)
+        if entry is not None and dict(zip(entry['files'], entry['mtimes'])) == {
+                os.path.basename(fn): os.path.getmtime(fn) for fn in files}:
+            continue
+        if extension == 'dcm':
+            headers = list(pool.map(read_slice_header, files, chunksize=8) if pool else map(read_slice_header, files))
+            order = sorted(range(len(files)), key=lambda idx: (headers[idx]['z'], files[idx]))
+        else:
+            headers = [{'z': float(idx), 'slope': 1.0, 'intercept': 0.0, 'shape': None} for idx in range(len(files))]
+            order = list(range(len(files)))
+        manifest['patients'][patent_no] = {
+            'n_slices': len(files),
+            'files': [os.path.basename(files[idx]) for idx in order],
+            'mtimes': [os.path.getmtime(files[idx]) for idx in order],
+            'z': [headers[idx]['z'] for idx in order],
+            'slope': [headers[idx]['slope'] for idx in order],
+            'intercept': [headers[idx]['intercept'] for idx in order],
+            'shape': headers[order[0]]['shape'] if files else None}
+        print('manifest : {} ({} slices)'.format(patent_no, len(files)))
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
 def read_function_png(fn):
     f = tf.io.read_file(filename=fn)
     f = tf.io.decode_png(contents=f, channels=1, dtype=tf.uint8)    # shape : W * H * ch
     return f
 
 
-def get_image_name(patent_no_list, length, domain_name):
+# <patent_no>_<domain>_<slice index>, slice index : position in the patient file list (dataset order)
+def get_image_name(patent_no_list, patient_files, domain_name):
     digit = 4
     slice_nm = []
 
     # sorted(idx), sorted(d_idx)  -> [1, 10, 2], [ 0001, 0002, 0010]
-    for patent_no in patent_no_list:
+    for patent_no, files in zip(patent_no_list, patient_files):
         pre_fix_nm = '{}_{}'.format(patent_no, domain_name)
-        for slice_number in range(length):
+        for slice_number in range(len(files)):
             s_idx = str(slice_number)
             d_idx = '0' * (digit - len(s_idx)) + s_idx
             slice_nm.append(pre_fix_nm + '_' + d_idx)
@@ -128,12 +284,57 @@ def get_image_name(patent_no_list, length, domain_name):
     return slice_nm
 
 
+# k stateless random crops of one slice, crop_seed : [2 * k] -> [k, patch_size, patch_size, C]
+def random_patches(x, crop_seed, patch_size, k):
+    crop_seed = tf.reshape(crop_seed, [k, 2])
+    size = tf.stack([patch_size, patch_size, tf.shape(x)[2]])
+    return tf.stack([tf.image.stateless_random_crop(x, size=size, seed=crop_seed[i]) for i in range(k)])
+
+
+def foreground_patches(x, crop_seed, patch_size, k, threshold, min_fraction):
+    """
+    k random patches whose foreground fraction (pixels > threshold) is at least min_fraction.
+    the window sums of every patch position are read from the integral image of the foreground mask,
+    positions are drawn uniformly among the valid ones (among all positions if none is valid)
+    crop_seed : [2 * k] -> [k, patch_size, patch_size, C]
+    """
+    mask = tf.cast(x[:, :, 0] > threshold, tf.float32)
+    integral = tf.pad(tf.math.cumsum(tf.math.cumsum(mask, axis=0), axis=1), [[1, 0], [1, 0]])
+    p = patch_size
+    window = integral[p:, p:] - integral[:-p, p:] - integral[p:, :-p] + integral[:-p, :-p]  # [H - p + 1, W - p + 1]
+    valid = window >= min_fraction * p * p
+    valid = tf.cond(tf.math.reduce_any(valid), lambda: valid, lambda: tf.ones_like(valid))
+    logits = tf.reshape(tf.where(valid, 0.0, -np.inf), [1, -1])
+    positions = tf.cast(tf.random.stateless_categorical(logits, k, seed=tf.reshape(crop_seed, [k, 2])[0])[0], tf.int32)
+    width = tf.shape(window)[1]
+    return tf.stack([tf.slice(x, tf.stack([positions[i] // width, positions[i] % width, 0]), [p, p, -1])
+                     for i in range(k)])
+
+
+# (LDCT, NDCT) seeds of one train epoch
+def epoch_seeds(seed, epoch):
+    ss = np.random.SeedSequence([seed, epoch])
+    return tuple(int(s) for s in ss.generate_state(2) % (2 ** 31 - 1))
+
+
 class DCMDataLoader(object):
     def __init__(self, data_path, image_size=512, patch_size=64, image_max=3071,
-                 image_min=-1024, batch_size=1, extension='dcm', phase='train'):
+                 image_min=-1024, batch_size=1, extension='dcm', phase='train', cache_dir=None,
+                 decode_workers=0, decode_queue=0, manifest=None, min_tissue_fraction=0.0, foreground_hu=-500):
         # dicom file dir
         self.extension = extension
         self.data_path = data_path
+        # patient manifest (build_manifest), patients not in the manifest are listed from their dir
+        self.manifest = load_manifest(manifest)
+        # HU slice cache dir (dcm only, None -> decode dicom every epoch)
+        self.cache_dir = cache_dir if extension == 'dcm' else None
+
+        # dicom decode worker processes (0 -> tf.py_function in the tf.data threads)
+        self.decode_workers = decode_workers if extension == 'dcm' else 0
+        self.decode_queue = decode_queue if decode_queue > 0 else 2 * self.decode_workers
+        self.decode_pool = None
+        # ingested HU cache volumes (memmaps) and flat slice index per patient list, loaded once per loader
+        self.cached_volumes = {}
 
         # image params
         self.image_size = image_size
@@ -141,6 +342,10 @@ class DCMDataLoader(object):
         self.image_max = image_max
         self.image_min = image_min
 
+        # foreground-aware patch sampling (0 : uniform random crop), foreground : HU > foreground_hu
+        self.min_tissue_fraction = min_tissue_fraction
+        self.foreground_threshold = (foreground_hu - image_min) / (image_max - image_min)
+
         # training params
         self.batch_size = batch_size
 
@@ -151,6 +356,9 @@ class DCMDataLoader(object):
         self.LDCT_images_size = 0
         self.NDCT_images_size = 0
 
+        # per patient source files, in the slice order of the datasets (test phase)
+        self.LDCT_patient_files, self.NDCT_patient_files = [], []
+
     # dicom file -> numpy array
     def __call__(self, patent_no_list_A, patent_no_list_B):
         def normalize(img):
@@ -158,59 +366,393 @@ class DCMDataLoader(object):
             img = (img - self.image_min) / (self.image_max - self.image_min)
             return img
 
-        def get_image_dataset(patent_no_list):
-            path_pattern_list = [os.path.join(self.data_path, patent_no, '*.' + self.extension) for patent_no in patent_no_list]
-            p_path = tf.data.Dataset.list_files(path_pattern_list)
-
-            # dcm
-            if self.extension == 'dcm':
-                p = p_path.map(read_function_dcm, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-            # png
+        def get_cached_dataset(patent_no_list, order=None):
+            volumes, slice_index = self.get_cached_volumes(patent_no_list)
+
+            def read_cached(idx):
+                return np.expand_dims(volumes[idx[0]][idx[1]], axis=-1)  # copy one slice out of the memmap
+
+            def read_function_cache(idx):
+                out = tf.numpy_function(read_cached, [idx], tf.int16)
+                out.set_shape([None, None, 1])
+                return out
+
+            if order is not None:
+                slice_index = slice_index[order]
+            p_idx = tf.data.Dataset.from_tensor_slices(slice_index)
+            if self.phase == 'train' and order is None:
+                p_idx = p_idx.shuffle(len(slice_index), reshuffle_each_iteration=True)
+            return p_idx.map(read_function_cache, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        def get_pool_dataset(files, order=None):
+            pool = self.get_decode_pool()
+
+            def decode_files():
+                file_order = order
+                if file_order is None:
+                    file_order = np.random.permutation(len(files)) if self.phase == 'train' else range(len(files))
+                # bounded queue of in-flight decodes, yielded in submission order
+                pending = collections.deque()
+                for idx in file_order:
+                    pending.append(pool.submit(read_hu, files[idx]))
+                    if len(pending) >= self.decode_queue:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+
+            return tf.data.Dataset.from_generator(decode_files, output_types=tf.int16,
+                                                  output_shapes=tf.TensorShape([None, None, 1]))
+
+        def get_patient_files(patent_no_list):
+            return [self.get_files(patent_no) for patent_no in patent_no_list]
+
+        # order : slice indices in read order (None : all slices, shuffled every iteration in train phase)
+        def get_image_dataset(patent_no_list, patient_files, order=None):
+            # slices of patient 1, patient 2, ... (shuffled in train phase)
+            files = [fn for p_files in patient_files for fn in p_files]
+
+            # cached HU slices
+            if self.cache_dir:
+                p = get_cached_dataset(patent_no_list, order)
+            # dcm, decoded in worker processes
+            elif self.decode_workers > 0:
+                p = get_pool_dataset(files, order)
             else:
-                p = p_path.map(read_function_png)
+                if order is not None:
+                    files = [files[idx] for idx in order]
+                p_path = tf.data.Dataset.from_tensor_slices(files)
+                if self.phase == 'train' and order is None:
+                    p_path = p_path.shuffle(len(files), reshuffle_each_iteration=True)
+
+                # dcm
+                if self.extension == 'dcm':
+                    p = p_path.map(read_function_dcm, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                # png
+                else:
+                    p = p_path.map(read_function_png)
             # normalization
             p = p.map(normalize, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
             return p
 
-        def len_image_dataset(patent_no_list):
-            data_size = 0
-            for patent_no in patent_no_list:
-                pattern = os.path.join(self.data_path, patent_no, '*.' + self.extension)
-                data_size += len(glob(pattern))
-            return data_size
-
-        self.LDCT_images = get_image_dataset(patent_no_list_A)
-        self.LDCT_images_size = len_image_dataset(patent_no_list_A)
-
-        self.NDCT_images = get_image_dataset(patent_no_list_B)
-        self.NDCT_images_size = len_image_dataset(patent_no_list_B)
+        # flat slice index -> normalized image, for index streams (get_stream_set)
+        def get_slice_reader(patent_no_list, patient_files):
+            files = [fn for p_files in patient_files for fn in p_files]
+
+            if self.cache_dir:
+                volumes, slice_index = self.get_cached_volumes(patent_no_list)
+
+                def read_index(idx):
+                    v_idx, s_idx = slice_index[idx]
+                    return np.expand_dims(volumes[v_idx][s_idx], axis=-1)
+            elif self.decode_workers > 0:
+                pool = self.get_decode_pool()
+
+                # each tf.data map thread waits on one worker process
+                def read_index(idx):
+                    return pool.submit(read_hu, files[idx]).result()
+            elif self.extension == 'dcm':
+                def read_index(idx):
+                    return read_hu(files[idx])
+            else:
+                file_tensor = tf.constant(files)
+                return lambda idx: normalize(read_function_png(tf.gather(file_tensor, idx)))
 
-        if self.phase != 'train':
-            self.LDCT_image_name = get_image_name(patent_no_list_A, self.LDCT_images_size, 'A')
-            self.NDCT_image_name = get_image_name(patent_no_list_B, self.NDCT_images_size, 'B')
+            def read_function_index(idx):
+                out = tf.numpy_function(read_index, [idx], tf.int16)
+                out.set_shape([None, None, 1])
+                return normalize(out)
 
-    def get_train_set(self, patch_size, whole_size=512):
-        whole_h = whole_w = whole_size
-        h = w = patch_size
+            return read_function_index
 
-        # patch image range
-        hd, hu = h // 2, int(whole_h - np.round(h / 2))
-        wd, wu = w // 2, int(whole_w - np.round(w / 2))
+        self.get_slice_reader = {'LDCT': lambda: get_slice_reader(patent_no_list_A, self.LDCT_patient_files),
+                                 'NDCT': lambda: get_slice_reader(patent_no_list_B, self.NDCT_patient_files)}
 
-        # patch image center(coordinate on whole image)
-        h_pc, w_pc = np.random.choice(range(hd, hu + 1)), np.random.choice(range(wd, wu + 1))
+        # LDCT / NDCT slices in a given order (epoch datasets of get_train_set)
+        self.get_ordered_images = {
+            'LDCT': lambda order: get_image_dataset(patent_no_list_A, self.LDCT_patient_files, order),
+            'NDCT': lambda order: get_image_dataset(patent_no_list_B, self.NDCT_patient_files, order)}
 
-        def patching(x):
-            return x[h_pc - hd: int(h_pc + np.round(h / 2)), w_pc - wd: int(w_pc + np.round(h / 2))]
+        self.LDCT_patient_files = get_patient_files(patent_no_list_A)
+        self.LDCT_images = get_image_dataset(patent_no_list_A, self.LDCT_patient_files)
+        self.LDCT_images_size = sum(len(p_files) for p_files in self.LDCT_patient_files)
 
-        ldct_patch_set = self.LDCT_images.map(patching, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-        ndct_patch_set = self.NDCT_images.map(patching, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        self.NDCT_patient_files = get_patient_files(patent_no_list_B)
+        self.NDCT_images = get_image_dataset(patent_no_list_B, self.NDCT_patient_files)
+        self.NDCT_images_size = sum(len(p_files) for p_files in self.NDCT_patient_files)
 
-        ldct_patch_set = ldct_patch_set.batch(self.batch_size)
-        ndct_patch_set = ndct_patch_set.batch(self.batch_size)
+        if self.phase != 'train':
+            self.LDCT_image_name = get_image_name(patent_no_list_A, self.LDCT_patient_files, 'A')
+            self.NDCT_image_name = get_image_name(patent_no_list_B, self.NDCT_patient_files, 'B')
+
+    # slice files of one patient (manifest : z order, else file name order)
+    def get_files(self, patent_no):
+        entry = self.manifest['patients'].get(patent_no)
+        if entry is None:
+            return sorted(glob(os.path.join(self.data_path, patent_no, '*.' + self.extension)))
+        return [os.path.join(self.data_path, patent_no, fn) for fn in entry['files']]
+
+    def get_decode_pool(self):
+        if self.decode_pool is None and self.decode_workers > 0:
+            # workers only run pydicom/numpy, so they are forked instead of re-importing tensorflow
+            self.decode_pool = ProcessPoolExecutor(max_workers=self.decode_workers,
+                                                   mp_context=multiprocessing.get_context('fork'))
+            self.decode_pool.submit(os.getpid).result()  # fork the workers now, from the main thread
+        return self.decode_pool
+
+    # dicom -> HU slice cache (one time)
+    def ingest(self, patent_no_list):
+        for patent_no in patent_no_list:
+            if build_hu_cache(self.data_path, patent_no, self.cache_dir, self.extension, self.get_decode_pool(),
+                              self.get_files(patent_no)):
+                print('HU cache : {} -> {}'.format(patent_no, hu_cache_path(self.cache_dir, patent_no)[0]))
+
+    # ingested (validated) HU cache volumes of a patient list and their [volume, slice] index, once per loader
+    def get_cached_volumes(self, patent_no_list):
+        key = tuple(patent_no_list)
+        if key not in self.cached_volumes:
+            self.ingest(patent_no_list)
+            volumes = [np.load(hu_cache_path(self.cache_dir, patent_no)[0], mmap_mode='r')
+                       for patent_no in patent_no_list]
+            slice_index = np.array([[v_idx, s_idx] for v_idx, volume in enumerate(volumes)
+                                    for s_idx in range(len(volume))], dtype=np.int64).reshape(-1, 2)
+            self.cached_volumes[key] = (volumes, slice_index)
+        return self.cached_volumes[key]
+
+    def get_train_set(self, patch_size, patches_per_slice=1, seed=None, drop_remainder=False, epoch=None,
+                      skip_slices=0, num_shards=1, shard_index=0, batch_size=None):
+        """
+        epoch=None : slices reshuffled at every iteration of the datasets
+        epoch      : one epoch, slice order and crops derived from (seed, epoch) only, so the same epoch can be
+                     rebuilt after a restart, skipping its first skip_slices slices without decoding them
+                     (exact position with patches_per_slice=1, with more patches the patch shuffle window differs)
+                     num_shards > 1 : the slices [shard_index::num_shards] of the epoch order (one worker), sharded
+                     before decoding, every shard has the same # of slices. skip_slices counts all shards
+        batch_size : default self.batch_size
+        """
+        k = patches_per_slice
+        batch_size = batch_size or self.batch_size
+
+        # k random patches per decoded slice, stateless crop with a per-slice seed
+        def patching(x, crop_seed):
+            return self.crop_patches(x, crop_seed, patch_size, k)
+
+        def get_patch_set(images, domain_seed):
+            # crop seed of a slice : its position in the epoch order
+            crop_seeds = tf.data.experimental.RandomDataset(seed=domain_seed).batch(2 * k)
+            crop_seeds = crop_seeds.shard(num_shards, shard_index).skip(skip_slices // num_shards)
+            patch_set = tf.data.Dataset.zip((images, crop_seeds))
+            patch_set = patch_set.map(patching, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            patch_set = patch_set.unbatch()
+            if k > 1:
+                # mix patches of different slices within a batch
+                patch_set = patch_set.shuffle(k * batch_size, seed=domain_seed)
+            return patch_set.batch(batch_size, drop_remainder=drop_remainder)
+
+        def shard_order(order):
+            order = order[:len(order) // num_shards * num_shards][shard_index::num_shards]
+            return order[skip_slices // num_shards:]
+
+        if epoch is None:
+            ldct_patch_set = get_patch_set(self.LDCT_images, seed)
+            ndct_patch_set = get_patch_set(self.NDCT_images, None if seed is None else seed + 1)
+        else:
+            ldct_seed, ndct_seed = epoch_seeds(seed, epoch)
+            ldct_order = shard_order(np.random.RandomState(ldct_seed).permutation(self.LDCT_images_size))
+            ndct_order = shard_order(np.random.RandomState(ndct_seed).permutation(self.NDCT_images_size))
+            ldct_patch_set = get_patch_set(self.get_ordered_images['LDCT'](ldct_order), ldct_seed)
+            ndct_patch_set = get_patch_set(self.get_ordered_images['NDCT'](ndct_order), ndct_seed)
 
         return ldct_patch_set, ndct_patch_set
 
-    def get_test_set(self):
-        return self.LDCT_images.batch(1), self.NDCT_images.batch(1)
+    # k patches of one normalized slice : uniform, or foreground-aware with min_tissue_fraction > 0
+    def crop_patches(self, x, crop_seed, patch_size, k):
+        if self.min_tissue_fraction > 0:
+            return foreground_patches(x, crop_seed, patch_size, k, self.foreground_threshold, self.min_tissue_fraction)
+        return random_patches(x, crop_seed, patch_size, k)
+
+    # decode the given files directly (no tf.data) -> normalized images [N, H, W, C] float32
+    def read_slices(self, files):
+        if self.extension == 'dcm':
+            pool = self.get_decode_pool()
+            hu = list(pool.map(read_hu, files)) if pool is not None else [read_hu(fn) for fn in files]
+        else:
+            hu = [read_function_png(fn).numpy() for fn in files]
+        return (np.stack(hu).astype(np.float32) - self.image_min) / (self.image_max - self.image_min)
+
+    def get_stream_set(self, patch_size, patches_per_slice=1, seed=0, epoch=0, cycle_length=4, shuffle_buffer=1024,
+                       skip_slices=0, num_shards=1, shard_index=0, batch_size=None):
+        """
+        streaming train set : endless, every domain sampled independently (the two sets have no common length).
+        patient order is reshuffled at every pass, cycle_length patients are read interleaved (slice by slice, in
+        file order within a patient) and the slice indices are shuffled with a bounded shuffle_buffer before decoding.
+        order and crops are derived from (seed, epoch), skip_slices drops the first slice indices before decoding.
+        num_shards > 1 : slice indices [shard_index::num_shards] of the stream (one worker), sharded before decoding
+        """
+        k = patches_per_slice
+        batch_size = batch_size or self.batch_size
+
+        def patching(x, crop_seed):
+            return self.crop_patches(x, crop_seed, patch_size, k)
+
+        def get_patch_set(domain, patient_files, domain_seed):
+            sizes = np.array([len(p_files) for p_files in patient_files if p_files], dtype=np.int64)
+            starts = np.cumsum(sizes) - sizes
+            patients = tf.data.Dataset.from_tensor_slices((starts, sizes))
+            patients = patients.shuffle(len(sizes), seed=domain_seed, reshuffle_each_iteration=True).repeat()
+            slices = patients.interleave(lambda start, size: tf.data.Dataset.range(start, start + size),
+                                         cycle_length=cycle_length, block_length=1)
+            slices = slices.shuffle(shuffle_buffer, seed=domain_seed)
+            slices = slices.shard(num_shards, shard_index).skip(skip_slices // num_shards)
+            images = slices.map(self.get_slice_reader[domain](), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+            crop_seeds = tf.data.experimental.RandomDataset(seed=domain_seed).batch(2 * k)
+            crop_seeds = crop_seeds.shard(num_shards, shard_index).skip(skip_slices // num_shards)
+            patch_set = tf.data.Dataset.zip((images, crop_seeds))
+            patch_set = patch_set.map(patching, num_parallel_calls=tf.data.experimental.AUTOTUNE).unbatch()
+            if k > 1:
+                patch_set = patch_set.shuffle(k * batch_size, seed=domain_seed)
+            return patch_set.batch(batch_size)
+
+        ldct_seed, ndct_seed = epoch_seeds(seed, epoch)
+        return (get_patch_set('LDCT', self.LDCT_patient_files, ldct_seed),
+                get_patch_set('NDCT', self.NDCT_patient_files, ndct_seed))
+
+    def get_test_set(self, batch_size=1):
+        return self.LDCT_images.batch(batch_size), self.NDCT_images.batch(batch_size)
+
+
+class VolumeWriter(threading.Thread):
+    """
+    background writer for test outputs.
+    generator output batches are put in slice order and written into one preallocated .npy volume
+    (n_slices, H, W, C) per patient, with a json sidecar. the volume can be loaded with np.load(mmap_mode='r')
+    """
+    def __init__(self, save_dir, patent_no_list, patient_files, domain_name, image_min, image_max, max_queue=8):
+        super(VolumeWriter, self).__init__(daemon=True)
+        self.save_dir = save_dir
+        self.patients = [(patent_no, files) for patent_no, files in zip(patent_no_list, patient_files) if files]
+        self.domain_name = domain_name
+        self.image_min = image_min
+        self.image_max = image_max
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+
+    # [B, H, W, C] batch, blocks while max_queue batches are waiting
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(np.asarray(batch))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def volume_path(self, patent_no):
+        return os.path.join(self.save_dir, 'Gen_from_{}_{}.npy'.format(patent_no, self.domain_name))
+
+    def run(self):
+        try:
+            patients = iter(self.patients)
+            volume, patent_no, files, pos = None, None, [], 0
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                for img in batch:
+                    if volume is None:
+                        patent_no, files = next(patients)
+                        volume = np.lib.format.open_memmap(self.volume_path(patent_no), mode='w+', dtype=img.dtype,
+                                                           shape=(len(files),) + img.shape)
+                        pos = 0
+                    volume[pos] = img
+                    pos += 1
+                    if pos == len(files):
+                        volume.flush()
+                        self.write_sidecar(patent_no, files, volume.shape, volume.dtype)
+                        volume = None
+        except Exception as e:
+            self.error = e
+            # keep draining so that put() never blocks on a dead writer
+            while self.queue.get() is not None:
+                pass
+
+    def write_sidecar(self, patent_no, files, shape, dtype):
+        sidecar = {'patent_no': patent_no, 'domain': self.domain_name,
+                   'shape': list(shape), 'dtype': str(dtype),
+                   # HU = value * (image_max - image_min) + image_min
+                   'image_min': self.image_min, 'image_max': self.image_max,
+                   'source_files': [os.path.basename(fn) for fn in files]}
+        with open(os.path.splitext(self.volume_path(patent_no))[0] + '.json', 'w') as f:
+            json.dump(sidecar, f, indent=2)
+
+
+class DicomSeriesWriter(threading.Thread):
+    """
+    background dicom writer for test outputs.
+    generator output batches are put in slice order, every slice is written by a worker process as a dicom
+    with the header of its source file : <save_dir>/<patent_no>_<domain>/<source file name>.
+    one new SeriesInstanceUID per output series, at most max_pending slices are waiting for a worker
+    """
+    def __init__(self, save_dir, patent_no_list, patient_files, domain_name, image_min, image_max, workers=4,
+                 max_queue=8, max_pending=0):
+        super(DicomSeriesWriter, self).__init__(daemon=True)
+        self.save_dir = save_dir
+        self.patients = [(patent_no, files) for patent_no, files in zip(patent_no_list, patient_files) if files]
+        self.domain_name = domain_name
+        self.image_min = image_min
+        self.image_max = image_max
+        self.max_pending = max_pending if max_pending > 0 else 2 * workers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        # workers only run pydicom/numpy, so they are forked instead of re-importing tensorflow
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        self.pool.submit(os.getpid).result()  # fork the workers now, from the main thread
+
+    # [B, H, W, C] batch, blocks while max_queue batches are waiting
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(np.asarray(batch))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self.pool.shutdown()
+        if self.error is not None:
+            raise self.error
+
+    def series_dir(self, patent_no):
+        return os.path.join(self.save_dir, '{}_{}'.format(patent_no, self.domain_name))
+
+    def run(self):
+        pending, closed = collections.deque(), False
+        try:
+            slices = ((patent_no, fn) for patent_no, files in self.patients for fn in files)
+            series_uids = {}
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    closed = True
+                    break
+                for img in batch:
+                    patent_no, src_path = next(slices)
+                    if patent_no not in series_uids:
+                        series_uids[patent_no] = generate_uid()
+                        if not os.path.exists(self.series_dir(patent_no)):
+                            os.makedirs(self.series_dir(patent_no))
+                    dst_path = os.path.join(self.series_dir(patent_no), os.path.basename(src_path))
+                    pending.append(self.pool.submit(write_dicom_slice, src_path, dst_path, img, self.image_min,
+                                                    self.image_max, series_uids[patent_no],
+                                                    'Gen_from_{}_{}'.format(patent_no, self.domain_name)))
+                    while len(pending) >= self.max_pending:
+                        pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        except Exception as e:
+            self.error = e
+            # keep draining so that put() never blocks on a dead writer
+            while not closed and self.queue.get() is not None:
+                pass
@@ -14,6 +14,9 @@ import argparse
 import os
 from cycle_identity_model import cycle_identity
 import inout_util as ut
+import infer
+import quantize
+import evaluate
 
 parser = argparse.ArgumentParser(description='')
 # -------------------------------------
@@ -32,16 +35,80 @@ parser.add_argument('--checkpoint_dir', dest='checkpoint_dir', default='/data/CY
                     help='check point dir')
 parser.add_argument('--test_npy_save_dir', dest='test_npy_save_dir', default='/data/CYCLEIDENT/test',
                     help='test numpy file save dir')
+parser.add_argument('--export_dir', dest='export_dir', default='/data/CYCLEIDENT/export',
+                    help='generator-only SavedModel export dir')
+parser.add_argument('--manifest', dest='manifest', default=None,
+                    help='patient manifest json (--phase manifest), file lists are read from it instead of the dirs')
+parser.add_argument('--cache_dir', dest='cache_dir', default=None,
+                    help='HU slice cache dir (dcm only). decoded once, reused while the dicom files are unchanged')
+
+# dicom decode
+parser.add_argument('--decode_workers', dest='decode_workers', type=int, default=0,
+                    help='# of dicom decode processes (0 : decode with tf.py_function)')
+parser.add_argument('--decode_queue', dest='decode_queue', type=int, default=0,
+                    help='max # of in-flight dicom decodes (0 : 2 * decode_workers)')
 
 # image info
 parser.add_argument('--patch_size', dest='patch_size', type=int, default=56, help='image patch size, h=w')
 parser.add_argument('--whole_size', dest='whole_size', type=int, default=512, help='image whole size, h=w')
+parser.add_argument('--patches_per_slice', dest='patches_per_slice', type=int, default=1,
+                    help='# of random patches cropped from each decoded slice')
+parser.add_argument('--pipeline', dest='pipeline', default='epoch', choices=['epoch', 'streaming'],
+                    help='epoch : LDCT / NDCT slices zipped once per epoch, '
+                         'streaming : endless patient-interleaved stream per domain, --steps_per_epoch steps per epoch')
+parser.add_argument('--cycle_length', dest='cycle_length', type=int, default=4,
+                    help='# of patients read interleaved (streaming)')
+parser.add_argument('--shuffle_buffer', dest='shuffle_buffer', type=int, default=1024,
+                    help='shuffle buffer of slice indices, before decoding (streaming)')
+parser.add_argument('--steps_per_epoch', dest='steps_per_epoch', type=int, default=0,
+                    help='steps per epoch (streaming), 0 : the larger domain once')
+parser.add_argument('--min_tissue_fraction', dest='min_tissue_fraction', type=float, default=0.0,
+                    help='min foreground fraction of a train patch (0 : uniform random crop)')
+parser.add_argument('--foreground_hu', dest='foreground_hu', type=int, default=-500,
+                    help='foreground (body) threshold in HU for --min_tissue_fraction')
 parser.add_argument('--img_channel', dest='img_channel', type=int, default=1, help='image channel, 1')
 parser.add_argument('--img_vmax', dest='img_vmax', type=int, default=3072, help='max value in image')
 parser.add_argument('--img_vmin', dest='img_vmin', type=int, default=-1024, help='max value in image')
 
 # train, test
-parser.add_argument('--phase', dest='phase', default='train', help='train, test')
+parser.add_argument('--phase', dest='phase', default='train', help='train, test, eval, manifest, ingest, export, quantize, quantize_eval')
+
+# test detail
+parser.add_argument('--test_output', dest='test_output', default='slice',
+                    help='slice : one .npy per slice, volume : one memory-mapped .npy volume (+ json) per patient, '
+                         'dicom : one dicom per slice with the source header (new series uid)')
+parser.add_argument('--write_workers', dest='write_workers', type=int, default=4,
+                    help='# of dicom writer processes (--test_output dicom)')
+parser.add_argument('--test_batch_size', dest='test_batch_size', type=int, default=1,
+                    help='# of slices per generator call in the test phase (--inference_graph folded only, else 1)')
+parser.add_argument('--eval_source', dest='eval_source', default='generator', choices=['generator', 'saved'],
+                    help='eval phase outputs. generator : latest checkpoint of taskID, saved : outputs of --phase test')
+parser.add_argument('--eval_workers', dest='eval_workers', type=int, default=4,
+                    help='# of metric worker processes (eval phase)')
+parser.add_argument('--eval_rois', dest='eval_rois', default='',
+                    help='noise std ROIs "y,x,h,w;y,x,h,w" (pixels), empty : whole_size / 8 square in the center')
+parser.add_argument('--psnr_range', dest='psnr_range', type=float, default=0,
+                    help='PSNR peak value in HU (eval phase), 0 : img_vmax - img_vmin')
+parser.add_argument('--inference_graph', dest='inference_graph', default='keras', choices=['keras', 'fused', 'folded'],
+                    help='generator graph for test / export. keras : trained graph, '
+                         'fused : pad merged into same convs (exact), folded : fused + batch norm folded into convs')
+parser.add_argument('--tile_size', dest='tile_size', type=int, default=0,
+                    help='tiled inference tile size, h=w (0 : whole image at once)')
+parser.add_argument('--tile_overlap', dest='tile_overlap', type=int, default=32,
+                    help='overlap between neighboring tiles, blended linearly')
+parser.add_argument('--tile_batch', dest='tile_batch', type=int, default=16, help='# of tiles per generator call')
+
+# export detail
+parser.add_argument('--export_direction', dest='export_direction', default='X2Y,Y2X',
+                    help='generators to export : X2Y, Y2X or X2Y,Y2X')
+
+# int8 quantization detail
+parser.add_argument('--quant_samples', dest='quant_samples', type=int, default=100,
+                    help='# of test slices in the representative dataset')
+parser.add_argument('--quant_eval_slices', dest='quant_eval_slices', type=int, default=0,
+                    help='# of test slices for quantize_eval (0 : all)')
+parser.add_argument('--quant_threads', dest='quant_threads', type=int, default=0,
+                    help='TFLite interpreter threads (0 : default)')
 
 # train detail
 parser.add_argument('--epoch', dest='epoch', type=int, default=160, help='set epoch')
@@ -56,14 +123,49 @@ parser.add_argument('--beta2', dest='beta2', type=float, default=0.999,
 parser.add_argument('--ngf', dest='ngf', type=int, default=128, help='# of gen filters in first conv layer')
 parser.add_argument('--nglf', dest='nglf', type=int, default=15, help='# of gen filters in last conv layer')
 parser.add_argument('--ndf', dest='ndf', type=int, default=64, help='# of discri filters in first conv layer')
+parser.add_argument('--jit', dest='jit', type=ut.ParseBoolean, default=False,
+                    help='XLA compiled train step with a fixed input signature (drops the last partial batch)')
+parser.add_argument('--recompute', dest='recompute', type=ut.ParseBoolean, default=False,
+                    help='recompute the generator module activations in backprop (less memory, slower step)')
+parser.add_argument('--precision', dest='precision', default='float32',
+                    choices=['float32', 'mixed_bfloat16', 'mixed_float16'],
+                    help='keras precision policy of the models (train / test), losses and variables stay float32')
 
 # others
 parser.add_argument('--save_freq', dest='save_freq', type=int, default=2378 * 2,
                     help='save a model every save_freq (iteration)')
+parser.add_argument('--keep_checkpoints', dest='keep_checkpoints', type=int, default=5,
+                    help='# of latest checkpoints to keep')
+parser.add_argument('--keep_best', dest='keep_best', type=int, default=1,
+                    help='# of best (evaluation PSNR) checkpoints to keep in <checkpoint_dir>/<taskID>/best')
+parser.add_argument('--async_checkpoint', dest='async_checkpoint', type=ut.ParseBoolean, default=True,
+                    help='write checkpoints in a background thread from a snapshot of the variables')
+parser.add_argument('--eval_size', dest='eval_size', type=int, default=32,
+                    help='# of test slices in the fixed evaluation subset (decoded once, PSNR / SSIM every print_freq)')
+parser.add_argument('--eval_batch_size', dest='eval_batch_size', type=int, default=8,
+                    help='# of slices per evaluation batch (generator calls : one slice, '
+                         'or the whole batch in --phase eval with --inference_graph folded)')
+parser.add_argument('--full_eval_freq', dest='full_eval_freq', type=int, default=0,
+                    help='PSNR / SSIM over all test slices every full_eval_freq (iterations), 0 : off')
+parser.add_argument('--summary_freq', dest='summary_freq', type=int, default=50,
+                    help='write the mean of the step losses to TensorBoard every summary_freq (iterations)')
+parser.add_argument('--summary_stats', dest='summary_stats', type=ut.ParseBoolean, default=False,
+                    help='also write min / max / std of the step losses per summary window')
 parser.add_argument('--print_freq', dest='print_freq', type=int, default=100 * 2, help='print_freq (iterations)')
+parser.add_argument('--step_log', dest='step_log', default=None,
+                    help='jsonl path : stage seconds, input queue depth and losses of every step (waits for each step)')
+parser.add_argument('--data_queue', dest='data_queue', type=int, default=0,
+                    help='# of train batches fetched ahead by a background thread (queue depth is logged), 0 : off')
+parser.add_argument('--profile_steps', dest='profile_steps', default='',
+                    help='tf.profiler trace of the steps "start,stop" (written to the TensorBoard log dir), empty : off')
 parser.add_argument('--continue_train', dest='continue_train', type=ut.ParseBoolean, default=True,
                     help='load the latest model: true, false')
-parser.add_argument('--gpu_no', dest='gpu_no', type=int, default=0, help='gpu no')
+parser.add_argument('--gpu_no', dest='gpu_no', default='0', help='gpu no, comma separated for --distribute mirrored')
+parser.add_argument('--distribute', dest='distribute', default='none', choices=['none', 'mirrored', 'multi_worker'],
+                    help='data parallel training : none, mirrored (local devices), multi_worker (TF_CONFIG cluster)')
+parser.add_argument('--cpu_replicas', dest='cpu_replicas', type=int, default=0,
+                    help='split the CPU into # logical devices (replicas of --distribute mirrored), 0 : off')
+parser.add_argument('--seed', dest='seed', type=int, default=None, help='random seed for slice order and patch cropping (a resumed run keeps the seed of its checkpoint)')
 
 # -------------------------------------
 args = parser.parse_args()
@@ -71,5 +173,35 @@ print(args)
 
 os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu_no)
 
-model = cycle_identity(args)
-model.train(args) if args.phase == 'train' else model.test(args)
+if args.phase == 'manifest':
+    # patient file lists, z-positions, rescale parameters -> manifest json (one time)
+    if not args.manifest:
+        raise ValueError('--manifest is required for --phase manifest')
+    loader = ut.DCMDataLoader(args.data_path, extension=args.extension, decode_workers=args.decode_workers)
+    ut.build_manifest(args.data_path, args.train_patient_no_A + args.train_patient_no_B + args.test_patient_no_A +
+                      args.test_patient_no_B, args.manifest, args.extension, loader.get_decode_pool())
+elif args.phase == 'ingest':
+    # dicom -> HU slice cache only
+    if args.extension != 'dcm' or not args.cache_dir:
+        raise ValueError('--phase ingest needs --cache_dir and dicom source files (--extension dcm)')
+    loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size, patch_size=args.patch_size,
+                              image_max=args.img_vmax, image_min=args.img_vmin, batch_size=args.batch_size,
+                              extension=args.extension, cache_dir=args.cache_dir,
+                              decode_workers=args.decode_workers, decode_queue=args.decode_queue,
+                              manifest=args.manifest)
+    loader.ingest(args.train_patient_no_A + args.train_patient_no_B + args.test_patient_no_A + args.test_patient_no_B)
+elif args.phase == 'export':
+    # checkpoint -> generator-only SavedModel
+    infer.export_generator(args)
+elif args.phase == 'quantize':
+    # checkpoint -> int8 TFLite generator
+    quantize.quantize_generator(args)
+elif args.phase == 'quantize_eval':
+    # fp32 vs int8 : slices/sec, PSNR
+    quantize.evaluate_quantized(args)
+elif args.phase == 'eval':
+    # PSNR / SSIM / RMSE (HU) / ROI noise of the full test outputs -> csv, json
+    evaluate.evaluate(args)
+else:
+    model = cycle_identity(args)
+    model.train(args) if args.phase == 'train' else model.test(args)
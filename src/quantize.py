@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    quantize.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+post-training int8 quantization of the generators (TFLite) for CPU inference.
+    python main.py --phase quantize ...       : checkpoint -> <export_dir>/<taskID>/generatorX2Y_int8.tflite
+    python main.py --phase quantize_eval ...  : slices/sec and PSNR of the int8 model against the folded fp32 generator
+the representative dataset and the evaluation slices are taken from the test lists with DCMDataLoader.
+"""
+
+import os
+import json
+import time
+import numpy as np
+import tensorflow as tf
+import cycle_identity_module as md
+import inout_util as ut
+import infer
+
+# test set used as generator input / reference for each direction
+DOMAINS = {'X2Y': ('LDCT', 'NDCT'), 'Y2X': ('NDCT', 'LDCT')}
+
+
+def tflite_path(args, direction):
+    return os.path.join(args.export_dir, args.taskID, infer.GENERATOR_NAMES[direction] + '_int8.tflite')
+
+
+def load_test_images(args):
+    loader = ut.DCMDataLoader(args.data_path, image_size=args.whole_size, patch_size=args.patch_size,
+                              image_max=args.img_vmax, image_min=args.img_vmin, batch_size=1,
+                              extension=args.extension, phase='test', cache_dir=args.cache_dir,
+                              decode_workers=args.decode_workers, decode_queue=args.decode_queue,
+                              manifest=args.manifest)
+    loader(args.test_patient_no_A, args.test_patient_no_B)
+    return {'LDCT': loader.LDCT_images, 'NDCT': loader.NDCT_images}
+
+
+def quantize_generator(args):
+    generators, options = infer.load_generators(args)
+    if generators is None:
+        return
+    images = load_test_images(args)
+
+    for direction in args.export_direction.split(','):
+        # batch norm folded graph with a fixed input shape, int8 weights and activations
+        image_shape = (args.whole_size, args.whole_size, args.img_channel)
+        model = md.fold_generator(generators[direction], options, fold_bn=True, image_shape=image_shape)
+        representative_set = images[DOMAINS[direction][0]].take(args.quant_samples).batch(1)
+
+        def representative_dataset():
+            for img in representative_set:
+                yield [img]
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        tflite_model = converter.convert()
+
+        save_path = tflite_path(args, direction)
+        if not os.path.exists(os.path.dirname(save_path)):
+            os.makedirs(os.path.dirname(save_path))
+        with open(save_path, 'wb') as f:
+            f.write(tflite_model)
+        print("Quantized generator : {} ({:.1f} MB)".format(save_path, len(tflite_model) / 2 ** 20))
+
+
+def evaluate_quantized(args):
+    """
+    batch norm folded fp32 generator (the graph that was quantized) vs int8 TFLite model on the test slices.
+    with --inference_graph keras / fused the fp32 graph is evaluated too, so the folding delta (graph -> folded)
+    and the quantization delta (folded -> int8) are reported separately.
+    PSNR against the paired slice of the other domain, same scale as the training summary (-1 ~ 1 -> 2)
+    """
+    generators, options = infer.load_generators(args)
+    if generators is None:
+        return
+    images = load_test_images(args)
+
+    for direction in args.export_direction.split(','):
+        fp32_models = {'folded': md.fold_generator(generators[direction], options, fold_bn=True)}
+        if args.inference_graph == 'fused':
+            fp32_models['fused'] = md.fold_generator(generators[direction], options, fold_bn=False)
+        elif args.inference_graph == 'keras':
+            fp32_models['keras'] = generators[direction]
+
+        interpreter = tf.lite.Interpreter(model_path=tflite_path(args, direction),
+                                          num_threads=args.quant_threads if args.quant_threads > 0 else None)
+        interpreter.allocate_tensors()
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+
+        def int8_model(x):
+            interpreter.set_tensor(input_index, x)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+
+        fp32_fns = {graph: tf.function(lambda x, m=model: m(x, training=False)) for graph, model in fp32_models.items()}
+
+        pairs = tf.data.Dataset.zip((images[DOMAINS[direction][0]], images[DOMAINS[direction][1]])).batch(1)
+        if args.quant_eval_slices > 0:
+            pairs = pairs.take(args.quant_eval_slices)
+
+        # warm up (tracing, allocation) before timing
+        for x, _ in pairs.take(1):
+            for fn in fp32_fns.values():
+                fn(x)
+            int8_model(x.numpy())
+
+        psnr = {key: [] for key in list(fp32_fns) + ['int8', 'int8_vs_folded']}
+        elapsed = {key: 0.0 for key in list(fp32_fns) + ['int8']}
+        if args.inference_graph != 'folded':
+            psnr['folded_vs_' + args.inference_graph] = []
+        for x, ref in pairs:
+            out = {}
+            for graph, fn in fp32_fns.items():
+                t = time.time()
+                out[graph] = fn(x).numpy()
+                elapsed[graph] += time.time() - t
+            t = time.time()
+            out['int8'] = int8_model(x.numpy())
+            elapsed['int8'] += time.time() - t
+
+            for key in elapsed:
+                psnr[key].append(float(ut.tf_psnr(ref, out[key], 2)))
+            psnr['int8_vs_folded'].append(float(ut.tf_psnr(out['folded'], out['int8'], 2)))
+            if args.inference_graph != 'folded':
+                psnr['folded_vs_' + args.inference_graph].append(
+                    float(ut.tf_psnr(out[args.inference_graph], out['folded'], 2)))
+
+        n = len(psnr['int8'])
+        mean = {key: float(np.mean(value)) for key, value in psnr.items()}
+        # psnr_drop : quantization only (folded fp32 -> int8), fold_psnr_drop : inference graph -> folded fp32
+        report = {'direction': direction, 'inference_graph': args.inference_graph, 'n_slices': n,
+                  'fp32_slices_per_sec': n / elapsed['folded'], 'int8_slices_per_sec': n / elapsed['int8'],
+                  'fp32_psnr': mean['folded'], 'int8_psnr': mean['int8'],
+                  'psnr_drop': mean['folded'] - mean['int8'], 'int8_vs_fp32_psnr': mean['int8_vs_folded']}
+        if args.inference_graph != 'folded':
+            graph = args.inference_graph
+            report.update({graph + '_slices_per_sec': n / elapsed[graph], graph + '_psnr': mean[graph],
+                           'fold_psnr_drop': mean[graph] - mean['folded'],
+                           'folded_vs_' + graph + '_psnr': mean['folded_vs_' + graph]})
+        print(json.dumps(report, indent=2))
+        with open(os.path.splitext(tflite_path(args, direction))[0] + '_eval.json', 'w') as f:
+            json.dump(report, f, indent=2)
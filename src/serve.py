@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    serve.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+long-running local inference server over the exported generators (python main.py --phase export).
+the generators are loaded once, concurrent requests are coalesced into batches (dynamic batching).
+    python serve.py --model_dir <export_dir>/<taskID> --port 8080 --max_batch 8 --max_latency_ms 10
+
+POST /denoise/X2Y (or /denoise/Y2X)
+    Content-Type: application/dicom        : one dicom file
+    Content-Type: application/octet-stream : raw int16 HU slices (little endian), headers X-Rows, X-Columns
+    response : chunked, one int16 HU slice (little endian, X-Rows x X-Columns) per chunk, in request order
+GET /health : loaded directions and batching settings (json)
+
+note : the generator normalizes with batch statistics unless it was exported with --inference_graph folded,
+       so the slices of other exports are run one at a time (max_batch 1, same as infer.GeneratorInference)
+"""
+
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+import inout_util as ut
+import infer
+
+
+class DynamicBatcher(object):
+    """
+    coalesce slices of concurrent requests into generator calls of at most max_batch slices.
+    a batch is run when max_batch slices are waiting, or max_latency seconds after its first request arrived.
+    fn : int16 HU images [N, H, W, C] -> HU images, slices of different sizes are run in separate calls
+    """
+    def __init__(self, fn, max_batch=8, max_latency=0.01):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.batches, self.slices = 0, 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # HU slices [N, H, W, C] of one request -> Futures of the output HU slices
+    def submit(self, images):
+        futures = [Future() for _ in images]
+        self.queue.put((images, futures))
+        return futures
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        size = len(item[0])
+        deadline = time.time() + self.max_latency
+        while size < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)  # stop after this batch
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            groups = {}
+            for images, futures in batch:
+                group = groups.setdefault(images.shape[1:], ([], []))
+                group[0].extend(images)
+                group[1].extend(futures)
+            for hu, futures in groups.values():
+                for b in range(0, len(hu), self.max_batch):
+                    self._call(hu[b:b + self.max_batch], futures[b:b + self.max_batch])
+
+    def _call(self, hu, futures):
+        try:
+            output = self.fn(np.stack(hu))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, img in zip(futures, output):
+            future.set_result(img)
+        self.batches += 1
+        self.slices += len(hu)
+
+
+# HU output -> int16 HU bytes (little endian)
+def hu_bytes(img):
+    return np.clip(np.round(img), -32768, 32767).astype('<i2').tobytes()
+
+
+# request body -> HU slices [N, H, W, 1] int16
+def read_request(content_type, headers, body):
+    if content_type == 'application/dicom':
+        return ut.get_pixel_hu(pydicom.dcmread(io.BytesIO(body)))[np.newaxis]
+    if content_type == 'application/octet-stream':
+        if headers.get('X-Rows') is None or headers.get('X-Columns') is None:
+            raise ValueError('raw int16 slices need the X-Rows and X-Columns headers')
+        rows, columns = int(headers['X-Rows']), int(headers['X-Columns'])
+        if rows <= 0 or columns <= 0:
+            raise ValueError('X-Rows and X-Columns must be positive')
+        if len(body) == 0 or len(body) % (rows * columns * 2) != 0:
+            raise ValueError('body size is not a multiple of X-Rows * X-Columns int16 slices')
+        return np.frombuffer(body, dtype='<i2').astype(np.int16).reshape(-1, rows, columns, 1)
+    raise ValueError('unsupported Content-Type : {}'.format(content_type))
+
+
+def make_handler(batchers, settings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            if settings['verbose']:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {'directions': sorted(batchers),
+                                 'max_batch': {d: b.max_batch for d, b in batchers.items()},
+                                 'max_latency_ms': settings['max_latency_ms'],
+                                 'batches': {d: b.batches for d, b in batchers.items()},
+                                 'slices': {d: b.slices for d, b in batchers.items()}})
+
+        def do_POST(self):
+            direction = self.path.rstrip('/').split('/')[-1]
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self.path.startswith('/denoise/') or direction not in batchers:
+                return self.send_json(404, {'error': 'unknown path {}, directions : {}'.format(
+                    self.path, sorted(batchers))})
+            try:
+                images = read_request(self.headers.get('Content-Type', '').split(';')[0].strip(),
+                                      self.headers, body)
+            except (ValueError, KeyError, InvalidDicomError, AttributeError) as e:
+                return self.send_json(400, {'error': str(e)})
+
+            # every slice is queued now, the responses are sent as the batches complete
+            futures = batchers[direction].submit(images)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.send_header('X-Rows', str(images.shape[1]))
+            self.send_header('X-Columns', str(images.shape[2]))
+            self.send_header('X-Slices', str(len(images)))
+            self.end_headers()
+            for future in futures:
+                chunk = hu_bytes(future.result())
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dynamic batching inference server of the exported generators')
+    parser.add_argument('--model_dir', dest='model_dir', required=True,
+                        help='<export_dir>/<taskID> with the exported generatorX2Y / generatorY2X')
+    parser.add_argument('--directions', dest='directions', default='X2Y,Y2X', help='generators to load')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='listen address')
+    parser.add_argument('--port', dest='port', type=int, default=8080, help='listen port')
+    parser.add_argument('--max_batch', dest='max_batch', type=int, default=8,
+                        help='max # of slices per batch (folded export only, else 1)')
+    parser.add_argument('--max_latency_ms', dest='max_latency_ms', type=float, default=10,
+                        help='max wait of the first slice of a batch for more slices (ms)')
+    parser.add_argument('--verbose', dest='verbose', type=ut.ParseBoolean, default=False, help='log every request')
+    args = parser.parse_args()
+
+    batchers = {}
+    for direction in args.directions.split(','):
+        model = infer.GeneratorInference(os.path.join(args.model_dir, infer.GENERATOR_NAMES[direction]), batch_size=1)
+        # slices are only batched when the output of a slice does not depend on its batch
+        max_batch = args.max_batch if model.batch_independent else 1
+        batchers[direction] = DynamicBatcher(model.denoise_hu, max_batch, args.max_latency_ms / 1000.0)
+        print('loaded {} : {} ({} graph, max_batch {})'.format(
+            direction, infer.GENERATOR_NAMES[direction], model.inference_graph, max_batch))
+
+    settings = {'max_latency_ms': args.max_latency_ms, 'verbose': args.verbose}
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batchers, settings))
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for batcher in batchers.values():
+            batcher.close()
+
+
+if __name__ == '__main__':
+    main()
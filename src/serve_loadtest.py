@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    serve_loadtest.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+
+load test of serve.py : p50 / p99 request latency and slices/sec at several concurrency levels.
+    python serve.py --model_dir <export_dir>/<taskID> --port 8080
+    python serve_loadtest.py --url http://127.0.0.1:8080 --concurrency 1,4,16 --requests 64 --size 512
+    python serve_loadtest.py ... --input_dir <dcm dir>    : send dicom files instead of synthetic raw slices
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import http.client
+from glob import glob
+from urllib.parse import urlparse
+import numpy as np
+
+
+def make_bodies(opt):
+    """request bodies : dicom files of --input_dir, or synthetic int16 HU slices (--slices_per_request each)"""
+    if opt.input_dir:
+        paths = sorted(glob(os.path.join(opt.input_dir, '*.' + opt.extension)))[:opt.requests]
+        bodies = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                bodies.append((f.read(), {'Content-Type': 'application/dicom'}))
+        return bodies
+    rng = np.random.RandomState(0)
+    headers = {'Content-Type': 'application/octet-stream', 'X-Rows': str(opt.size), 'X-Columns': str(opt.size)}
+    bodies = []
+    for _ in range(min(opt.requests, 8)):
+        hu = rng.normal(40, 80, size=(opt.slices_per_request, opt.size, opt.size)).astype('<i2')
+        bodies.append((hu.tobytes(), headers))
+    return bodies
+
+
+def send(url, path, body, headers):
+    """one request, returns (latency seconds, # of response slices)"""
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=600)
+    t = time.time()
+    conn.request('POST', path, body=body, headers=headers)
+    response = conn.getresponse()
+    data = response.read()  # chunked slices
+    latency = time.time() - t
+    if response.status != 200:
+        raise RuntimeError('{} : {}'.format(response.status, data.decode('utf-8', 'replace')))
+    slices = int(response.getheader('X-Slices'))
+    conn.close()
+    return latency, slices
+
+
+def run_level(opt, url, bodies, concurrency):
+    latencies, slices, errors = [], [0], []
+    lock = threading.Lock()
+    counter = iter(range(opt.requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            body, headers = bodies[i % len(bodies)]
+            try:
+                latency, n = send(url, '/denoise/' + opt.direction, body, headers)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(latency)
+                slices[0] += n
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t
+
+    result = {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors),
+              'slices_per_sec': slices[0] / elapsed}
+    if latencies:
+        result.update({'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                       'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                       'mean_ms': float(np.mean(latencies) * 1000)})
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test of the inference server')
+    parser.add_argument('--url', dest='url', default='http://127.0.0.1:8080', help='server url')
+    parser.add_argument('--direction', dest='direction', default='X2Y', help='X2Y, Y2X')
+    parser.add_argument('--concurrency', dest='concurrency', default='1,4,16',
+                        help='# of concurrent clients, comma separated')
+    parser.add_argument('--requests', dest='requests', type=int, default=64, help='# of requests per level')
+    parser.add_argument('--warmup', dest='warmup', type=int, default=2, help='# of untimed requests')
+    parser.add_argument('--size', dest='size', type=int, default=512, help='synthetic slice size, h=w')
+    parser.add_argument('--slices_per_request', dest='slices_per_request', type=int, default=1,
+                        help='# of synthetic slices per request')
+    parser.add_argument('--input_dir', dest='input_dir', default=None, help='send the dicom files of this dir')
+    parser.add_argument('--extension', dest='extension', default='dcm', help='file extension (input_dir)')
+    parser.add_argument('--output', dest='output', default=None, help='result json path')
+    opt = parser.parse_args()
+
+    url = urlparse(opt.url)
+    bodies = make_bodies(opt)
+    for i in range(opt.warmup):
+        send(url, '/denoise/' + opt.direction, *bodies[i % len(bodies)])
+
+    result = [run_level(opt, url, bodies, int(c)) for c in opt.concurrency.split(',')]
+    print(json.dumps(result, indent=2))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
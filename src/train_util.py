@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Module:    train_util.py
+Language:  Python3
+Date:      2026-10-18 10:00:00
+Version:   open.VER 1.0
+
+Copyright (c) Promedius.
+All rights reserved.
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+import contextlib
+import numpy as np
+import tensorflow as tf
+
+
+class LossAccumulator(object):
+    """
+    buffered loss summary.
+    update() runs inside the (compiled) train step and only touches variables,
+    write() sends the window mean (and min / max / std with stats=True) to TensorBoard and starts a new window.
+    summaries : [(name_scope, summary_name, loss key), ...]
+    """
+    def __init__(self, summaries, stats=False):
+        self.summaries = summaries
+        self.stats = stats
+        self.means = {key: tf.keras.metrics.Mean(name=key) for _, _, key in summaries}
+        if stats:
+            self.sq_means = {key: tf.keras.metrics.Mean(name=key + '_sq') for _, _, key in summaries}
+            self.mins = {key: tf.Variable(np.inf, dtype=tf.float32, trainable=False) for _, _, key in summaries}
+            self.maxs = {key: tf.Variable(-np.inf, dtype=tf.float32, trainable=False) for _, _, key in summaries}
+
+    def update(self, losses):
+        for _, _, key in self.summaries:
+            value = tf.cast(losses[key], tf.float32)
+            self.means[key].update_state(value)
+            if self.stats:
+                self.sq_means[key].update_state(tf.math.square(value))
+                self.mins[key].assign(tf.math.minimum(self.mins[key], value))
+                self.maxs[key].assign(tf.math.maximum(self.maxs[key], value))
+
+    def count(self):
+        return int(next(iter(self.means.values())).count.numpy())
+
+    def reset(self):
+        for _, _, key in self.summaries:
+            self.means[key].reset_state()
+            if self.stats:
+                self.sq_means[key].reset_state()
+                self.mins[key].assign(np.inf)
+                self.maxs[key].assign(-np.inf)
+
+    def write(self, writer, step):
+        if self.count() == 0:
+            return
+        with writer.as_default():
+            for scope, name, key in self.summaries:
+                mean = self.means[key].result()
+                with tf.name_scope(scope):
+                    tf.summary.scalar(name=name, data=mean, step=step)
+                    if self.stats:
+                        std = tf.math.sqrt(tf.math.maximum(self.sq_means[key].result() - mean ** 2, 0.))
+                        tf.summary.scalar(name=name + '_std', data=std, step=step)
+                        tf.summary.scalar(name=name + '_min', data=self.mins[key], step=step)
+                        tf.summary.scalar(name=name + '_max', data=self.maxs[key], step=step)
+        self.reset()
+
+
+class EvalSubset(object):
+    """
+    fixed evaluation subset : size paired test slices picked with seed, decoded once and kept in memory.
+    loader : DCMDataLoader of the test lists (phase='test', LDCT / NDCT slices are paired by order)
+    """
+    def __init__(self, loader, size, seed=0, batch_size=8):
+        n = min(loader.LDCT_images_size, loader.NDCT_images_size)
+        self.index = np.sort(np.random.RandomState(seed).choice(n, min(size, n), replace=False))
+        LDCT_files = [fn for p_files in loader.LDCT_patient_files for fn in p_files]
+        NDCT_files = [fn for p_files in loader.NDCT_patient_files for fn in p_files]
+        self.X = loader.read_slices([LDCT_files[i] for i in self.index])
+        self.Y = loader.read_slices([NDCT_files[i] for i in self.index])
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for b in range(0, len(self.index), self.batch_size):
+            yield self.X[b:b + self.batch_size], self.Y[b:b + self.batch_size]
+
+
+# per image PSNR / SSIM : [N, H, W, C] -> [N]
+# psnr_max : same scale as the PSNR summary of the original training code, ssim_max : range of the normalized images
+def image_metrics(ref, out, psnr_max=2.0, ssim_max=1.0):
+    return tf.image.psnr(ref, out, max_val=psnr_max), tf.image.ssim(ref, out, max_val=ssim_max)
+
+
+def evaluate_generators(generator_G, generator_F, pairs):
+    """
+    inference over (X, Y) batches (EvalSubset, or a streamed test set)
+    the generators normalize with batch statistics, so they are called one slice at a time : the metrics do not
+    depend on the batch size and the outputs are those of --phase test (keras graph)
+    returns {metric: (mean, std)}, metrics : psnr (X vs Y), psnr_AtoB (G(X) vs Y), psnr_BtoA (F(Y) vs X), ssim_*
+    """
+    def generate(generator, images):
+        return tf.concat([generator(images[i:i + 1], training=False) for i in range(images.shape[0])], axis=0)
+
+    values = {'psnr': [], 'psnr_AtoB': [], 'psnr_BtoA': [], 'ssim': [], 'ssim_AtoB': [], 'ssim_BtoA': []}
+    for X, Y in pairs:
+        G_X = generate(generator_G, X)
+        F_Y = generate(generator_F, Y)
+        for suffix, ref, out in (('', Y, X), ('_AtoB', Y, G_X), ('_BtoA', X, F_Y)):
+            psnr, ssim = image_metrics(ref, out)
+            values['psnr' + suffix].append(psnr.numpy())
+            values['ssim' + suffix].append(ssim.numpy())
+
+    return {key: (float(np.mean(np.concatenate(v))), float(np.std(np.concatenate(v)))) for key, v in values.items()}
+
+
+def write_eval_summary(writer, scope, metrics, step):
+    names = [('1_psnr', 'psnr'), ('2_psnr_AtoB', 'psnr_AtoB'), ('2_psnr_BtoA', 'psnr_BtoA'),
+             ('3_ssim', 'ssim'), ('4_ssim_AtoB', 'ssim_AtoB'), ('4_ssim_BtoA', 'ssim_BtoA')]
+    with writer.as_default():
+        with tf.name_scope(scope):
+            for name, key in names:
+                mean, std = metrics[key]
+                tf.summary.scalar(name=name, data=mean, step=step)
+                tf.summary.scalar(name=name + '_std', data=std, step=step)
+
+
+def get_strategy(distribute='none', cpu_replicas=0):
+    """
+    distribute : none         -> default strategy (one device)
+                 mirrored     -> MirroredStrategy over the local GPUs, or over cpu_replicas logical CPU devices
+                 multi_worker -> MultiWorkerMirroredStrategy, cluster from the TF_CONFIG environment variable
+    cpu_replicas : split the CPU into this many logical devices (before tensorflow initializes the devices)
+    """
+    if cpu_replicas > 1:
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * cpu_replicas)
+
+    if distribute == 'mirrored':
+        devices = None
+        if cpu_replicas > 1 and not tf.config.list_physical_devices('GPU'):
+            devices = [device.name for device in tf.config.list_logical_devices('CPU')]
+        return tf.distribute.MirroredStrategy(devices)
+    elif distribute == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+
+def is_chief(strategy):
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return True
+    if resolver.task_type == 'chief':
+        return True
+    return resolver.task_type == 'worker' and resolver.task_id == 0 and 'chief' not in resolver.cluster_spec().as_dict()
+
+
+# integer value of the chief worker on every worker : all-reduce sum, the other workers send 0
+# (float64 is exact for the value split over the local replicas of the chief)
+def broadcast_from_chief(strategy, value, chief):
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return value
+    local_replicas = len(strategy.extended.worker_devices)
+    local = tf.constant(float(value) / local_replicas if chief else 0., dtype=tf.float64)
+    per_replica = strategy.run(lambda: tf.identity(local))
+    return int(round(float(strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica, axis=None).numpy())))
+
+
+# scratch dir of a non-chief worker (checkpoints are saved by all workers)
+def worker_dir(checkpoint_dir, strategy):
+    resolver = strategy.cluster_resolver
+    return os.path.join(checkpoint_dir, 'workertemp_{}_{}'.format(resolver.task_type, resolver.task_id))
+
+
+# tf.train.CheckpointOptions, async_write : snapshot of the variables written in a background thread (if supported)
+def checkpoint_options(async_write=True):
+    if not async_write:
+        return tf.train.CheckpointOptions()
+    try:
+        return tf.train.CheckpointOptions(enable_async=True)
+    except TypeError:
+        try:
+            return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        except TypeError:
+            return tf.train.CheckpointOptions()
+
+
+# # of workers of a multi_worker cluster (1 : local strategies)
+def num_workers(strategy):
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None:
+        return 1
+    spec = resolver.cluster_spec().as_dict()
+    return max(len(spec.get('chief', [])) + len(spec.get('worker', [])), 1)
+
+
+class StageTimer(object):
+    """
+    wall clock seconds per training stage (data_wait, step, summary, eval, checkpoint ...) over a window.
+        with timer('step'):
+            train_step(...)
+    lap() returns {stage: seconds} of the window (+ 'other' : the time outside the timed stages) and starts a new one
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.start = time.time()
+
+    def __call__(self, stage):
+        return _Stage(self, stage)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def lap(self):
+        now = time.time()
+        seconds = dict(self.seconds)
+        seconds['other'] = max(now - self.start - sum(seconds.values()), 0.0)
+        seconds['total'] = now - self.start
+        self.seconds, self.start = {}, now
+        return seconds
+
+
+class _Stage(object):
+    def __init__(self, timer, stage):
+        self.timer, self.stage = timer, stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.stage, time.time() - self.start)
+
+
+class QueuedIterator(object):
+    """
+    iterator over a (distributed) dataset, filled by a background thread into a queue of depth batches.
+    depth() is the number of ready batches : ~0 at every step -> the input pipeline is the bottleneck
+    """
+    _END = object()
+
+    def __init__(self, dataset, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._fill, args=(iter(dataset),), daemon=True)
+        self.thread.start()
+
+    def _fill(self, iterator):
+        try:
+            for batch in iterator:
+                self.queue.put(batch)
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(self._END)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.queue.get()
+        if batch is self._END:
+            raise StopIteration
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+
+class StepLogger(object):
+    """
+    structured step log : one json object per line (step, epoch, stage seconds, input queue depth, losses)
+    path None -> no-op
+    """
+    def __init__(self, path):
+        self.file = None
+        if path:
+            if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.file = open(path, 'a')
+
+    def __bool__(self):
+        return self.file is not None
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ProfilerWindow(object):
+    """
+    tf.profiler trace of the steps [start, stop), written to log_dir (TensorBoard profile plugin).
+    steps : 'start,stop' or '' (off). call update(step) before each step
+    """
+    def __init__(self, steps, log_dir):
+        self.start, self.stop = [int(s) for s in steps.split(',')] if steps else (-1, -1)
+        self.log_dir = log_dir
+        self.active = False
+
+    def update(self, step):
+        if not self.active and self.start <= step < self.stop:
+            tf.profiler.experimental.start(self.log_dir)
+            self.active = True
+        elif self.active and step >= self.stop:
+            self.close()
+
+    def trace(self, step):
+        # step marker of the trace viewer / overview page
+        if self.active:
+            return tf.profiler.experimental.Trace('train', step_num=step, _r=1)
+        return contextlib.nullcontext()
+
+    def close(self):
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False